@@ -1,15 +1,57 @@
 import cv2
 import numpy as np
 
-def canny_edge_detector(current_image):
-    # blurring
-    blurred = cv2.GaussianBlur(current_image, (5, 5), 0)
-    # canny
-    sigma = 0.33
-    v = np.median(current_image)
+
+def gaussian_kernel(scale=1.0):
+    """
+    1D Gaussian kernel of the blur before the edge detection, applied with cv2.sepFilter2D.
+    :param scale: size of the image relative to the full resolution frame. The blur is shrunk by the same factor,
+                  so a downscaled preview shows the same edges as the full frame would.
+    :return: kernel or None if the blur is too small to change the image
+    """
+    if scale >= 1.0:
+        return cv2.getGaussianKernel(5, 0)
+    # sigma OpenCV uses for the 5x5 kernel at full resolution, scaled to the image
+    sigma = 0.3 * ((5 - 1) * 0.5 - 1) + 0.8
+    sigma = sigma * scale
+    if sigma < 0.5:
+        return None
+    ksize = 2 * int(np.ceil(2 * sigma)) + 1
+    return cv2.getGaussianKernel(ksize, sigma)
+
+
+def median_intensity(image):
+    # same value as np.median, but from the 256 bin histogram instead of sorting a copy of the image
+    cumulative = np.cumsum(cv2.calcHist([image], [0], None, [256], [0, 256]).ravel())
+    n = image.size
+    lower = np.searchsorted(cumulative, (n - 1) // 2 + 1)
+    upper = np.searchsorted(cumulative, n // 2 + 1)
+    return (lower + upper) / 2
+
+
+def canny_thresholds(image, sigma=0.33):
+    v = median_intensity(image)
     lower = int(max(0, (1.0-sigma) * v))
     upper = int(min(255, (1.0+sigma) * v))
+    return lower, upper
+
+
+def canny_edge_detector(current_image, scale=1.0):
+    """
+    canny edge detection with thresholds from the median of the image.
+    :param current_image: grayscale image
+    :param scale: size of the image relative to the full resolution frame, see gaussian_kernel()
+    :return: edge image
+    """
+    # blurring
+    kernel = gaussian_kernel(scale)
+    if kernel is None:
+        blurred = current_image
+    else:
+        blurred = cv2.sepFilter2D(current_image, -1, kernel, kernel)
+    # canny
+    lower, upper = canny_thresholds(current_image)
     auto = cv2.Canny(blurred, lower, upper)
     edge_image = auto
 
-    return edge_image
\ No newline at end of file
+    return edge_image
@@ -0,0 +1,452 @@
+import cv2
+
+from scripts import canny_edge_detection, sharpen, video_statistics
+from scripts.lut_compiler import compile_lut
+
+
+def on_luminance(image, operation):
+    # operations defined on grayscale images are applied to the luminance of colour images
+    if image.ndim == 2:
+        return operation(image)
+    ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
+    ycrcb[:, :, 0] = operation(ycrcb[:, :, 0])
+    return cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+
+
+class LuminanceOperator:
+    """
+    on_luminance() for many frames, the YCrCb buffers are allocated once and reused
+    """
+
+    def __init__(self, gray_operator):
+        self.gray_operator = gray_operator
+        self._ycrcb = None
+        self._luminance = None
+        self._out = None
+
+    def __call__(self, image):
+        if image.ndim == 2:
+            return self.gray_operator(image)
+        # opencv reallocates the buffers itself if the frame size changes
+        self._ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb, dst=self._ycrcb)
+        self._luminance = cv2.extractChannel(self._ycrcb, 0, dst=self._luminance)
+        cv2.insertChannel(self.gray_operator(self._luminance), self._ycrcb, 0)
+        self._out = cv2.cvtColor(self._ycrcb, cv2.COLOR_YCrCb2BGR, dst=self._out)
+        return self._out
+
+
+class LutOperator:
+    def __init__(self, table):
+        self.table = table
+        self._out = None
+
+    def __call__(self, image):
+        self._out = cv2.LUT(image, self.table, dst=self._out)
+        return self._out
+
+
+class EqualizeOperator:
+    def __init__(self):
+        self._out = None
+
+    def __call__(self, image):
+        self._out = cv2.equalizeHist(image, dst=self._out)
+        return self._out
+
+
+class ClaheOperator:
+    def __init__(self, clip_limit):
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit)
+        self._out = None
+
+    def __call__(self, image):
+        self._out = self.clahe.apply(image, dst=self._out)
+        return self._out
+
+
+class SharpenOperator:
+    def __init__(self, scale):
+        self.kernel = sharpen.sharpen_kernel(scale)
+        self._out = None
+
+    def __call__(self, image):
+        self._out = cv2.filter2D(image, -1, self.kernel, dst=self._out)
+        return self._out
+
+
+class CannyOperator:
+    def __init__(self, scale):
+        self.kernel = canny_edge_detection.gaussian_kernel(scale)
+        self._gray = None
+        self._blurred = None
+        self._edges = None
+
+    def __call__(self, image):
+        if image.ndim == 3:
+            self._gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            image = self._gray
+        blurred = image
+        if self.kernel is not None:
+            self._blurred = cv2.sepFilter2D(image, -1, self.kernel, self.kernel, dst=self._blurred)
+            blurred = self._blurred
+        lower, upper = canny_edge_detection.canny_thresholds(image)
+        self._edges = cv2.Canny(blurred, lower, upper, edges=self._edges)
+        return self._edges
+
+
+class EnhancementStage:
+    """
+    one enhancement of the pipeline with its parameters.
+    Point operations map every pixel value on its own and can be fused with their neighbours into one lookup
+    table, all other stages work on the whole image.
+    """
+    name = None
+    point_operation = False
+
+    def __init__(self, **params):
+        self.params = params
+
+    def operation(self):
+        """
+        operation tuple for lut_compiler.compile_lut(), only for point operations
+        """
+        raise NotImplementedError
+
+    def table(self):
+        return compile_lut((self.operation(),))
+
+    def apply(self, image, scale=1.0):
+        """
+        :param image: grayscale or BGR image
+        :param scale: size of the image relative to the full resolution frame, for stages with neighbourhoods
+        :return: enhanced image
+        """
+        if self.point_operation:
+            return cv2.LUT(image, self.table())
+        raise NotImplementedError
+
+    def operator(self, scale=1.0):
+        """
+        callable which applies the stage to many frames of the same size. Everything the stage needs (tables,
+        kernels, CLAHE objects) is built here once and the output buffers are reused, so the returned image is
+        only valid until the next call.
+        """
+        if self.point_operation:
+            return LutOperator(self.table())
+        return lambda image: self.apply(image, scale=scale)
+
+    def bind(self, video_path, cached_only=False):
+        """
+        the stage for one video, stages which depend on the whole video (e.g. its histogram) resolve it here
+        :param cached_only: only use what was computed for the video before, never read the video. Used by the
+                            preview, which mustn't wait for a pass over the whole video
+        """
+        return self
+
+    def key(self):
+        # identifies the stage and its parameters, used for the stage result cache
+        return (self.name,) + tuple(sorted(self.params.items()))
+
+    def to_dict(self):
+        return dict(stage=self.name, **self.params)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.params == other.params
+
+    def __repr__(self):
+        params = ", ".join("{}={}".format(key, value) for key, value in self.params.items())
+        return "{}({})".format(self.name, params)
+
+
+class GammaStage(EnhancementStage):
+    name = "gamma"
+    point_operation = True
+
+    def __init__(self, gamma_value=10):
+        # gamma_value in slider units, 10 means gamma 1.0
+        super(GammaStage, self).__init__(gamma_value=gamma_value)
+
+    def operation(self):
+        return ("gamma", self.params["gamma_value"])
+
+
+class BrightnessStage(EnhancementStage):
+    name = "brightness"
+    point_operation = True
+
+    def __init__(self, brightness_value=0):
+        # [-255;255]
+        super(BrightnessStage, self).__init__(brightness_value=brightness_value)
+
+    def operation(self):
+        return ("brightness", self.params["brightness_value"])
+
+
+class ContrastStage(EnhancementStage):
+    name = "contrast"
+    point_operation = True
+
+    def __init__(self, contrast_value=0):
+        # [-127;127]
+        super(ContrastStage, self).__init__(contrast_value=contrast_value)
+
+    def operation(self):
+        return ("contrast", self.params["contrast_value"])
+
+
+class InvertStage(EnhancementStage):
+    name = "invert"
+    point_operation = True
+
+    def operation(self):
+        return ("invert",)
+
+
+class ClipStage(EnhancementStage):
+    name = "clip"
+    point_operation = True
+
+    def __init__(self, low=0, high=255):
+        super(ClipStage, self).__init__(low=low, high=high)
+
+    def operation(self):
+        return ("clip", self.params["low"], self.params["high"])
+
+
+class VideoEqualizeStage(EnhancementStage):
+    """
+    histogram equalization with the histogram of the whole video instead of each frame, so all frames get the
+    same mapping. Without a table the stage is resolved from the video statistics when it's bound to a video.
+    Like the frame level equalization the table is applied to the luminance of colour frames, so it can't be
+    fused with the point operations which work on every channel.
+    """
+    name = "video_equalize"
+
+    def __init__(self, table=None):
+        super(VideoEqualizeStage, self).__init__(table=tuple(table) if table is not None else None)
+
+    def bind(self, video_path, cached_only=False):
+        if self.params["table"] is not None:
+            return self
+        if cached_only:
+            statistics = video_statistics.cached_statistics(video_path)
+            if statistics is None:
+                # stands in until the statistics of the video were accumulated
+                return EqualizeStage()
+        else:
+            statistics = video_statistics.get_statistics(video_path)
+        if statistics is None:
+            return VideoEqualizeStage(tuple(range(256)))
+        return VideoEqualizeStage(statistics.equalization_table())
+
+    def operation(self):
+        if self.params["table"] is None:
+            raise ValueError("video_equalize stage has to be bound to a video first")
+        return ("equalize", self.params["table"])
+
+    def apply(self, image, scale=1.0):
+        table = self.table()
+        return on_luminance(image, lambda luminance: cv2.LUT(luminance, table))
+
+    def operator(self, scale=1.0):
+        return LuminanceOperator(LutOperator(self.table()))
+
+    def __repr__(self):
+        # the table is too long for the log
+        return "{}({})".format(self.name, "video histogram" if self.params["table"] is None else "table")
+
+    def to_dict(self):
+        table = self.params["table"]
+        return dict(stage=self.name, table=list(table) if table is not None else None)
+
+
+class EqualizeStage(EnhancementStage):
+    name = "equalize"
+
+    def apply(self, image, scale=1.0):
+        return on_luminance(image, cv2.equalizeHist)
+
+    def operator(self, scale=1.0):
+        return LuminanceOperator(EqualizeOperator())
+
+
+class ClaheStage(EnhancementStage):
+    name = "clahe"
+
+    def __init__(self, clip_limit=40):
+        super(ClaheStage, self).__init__(clip_limit=clip_limit)
+
+    def apply(self, image, scale=1.0):
+        clahe = cv2.createCLAHE(clipLimit=self.params["clip_limit"])
+        return on_luminance(image, clahe.apply)
+
+    def operator(self, scale=1.0):
+        return LuminanceOperator(ClaheOperator(self.params["clip_limit"]))
+
+
+class SharpenStage(EnhancementStage):
+    name = "sharpen"
+
+    def apply(self, image, scale=1.0):
+        return sharpen.sharpen(image, scale=scale)
+
+    def operator(self, scale=1.0):
+        return SharpenOperator(scale)
+
+
+class CannyStage(EnhancementStage):
+    name = "canny"
+
+    def apply(self, image, scale=1.0):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return canny_edge_detection.canny_edge_detector(image, scale=scale)
+
+    def operator(self, scale=1.0):
+        return CannyOperator(scale)
+
+
+# stage classes by name, used to rebuild pipelines from their dict form
+STAGES = {stage.name: stage for stage in [GammaStage, BrightnessStage, ContrastStage, InvertStage, ClipStage,
+                                          VideoEqualizeStage, EqualizeStage, ClaheStage, SharpenStage, CannyStage]}
+
+
+class FusedPointPass:
+    """
+    consecutive point operations compiled into one table, so they cost a single cv2.LUT over the frame
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.table = compile_lut(tuple(stage.operation() for stage in stages))
+
+    def apply(self, image, scale=1.0):
+        return cv2.LUT(image, self.table)
+
+    def operator(self, scale=1.0):
+        return LutOperator(self.table)
+
+
+class StagePass:
+    """
+    a single stage which can't be fused with its neighbours
+    """
+
+    def __init__(self, stage):
+        self.stages = [stage]
+
+    def apply(self, image, scale=1.0):
+        return self.stages[0].apply(image, scale=scale)
+
+    def operator(self, scale=1.0):
+        return self.stages[0].operator(scale)
+
+
+class EnhancementPipeline:
+    """
+    ordered list of enhancement stages, executed the same way by the preview and the export.
+    """
+
+    def __init__(self, stages=None):
+        self.stages = list(stages) if stages is not None else []
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return self
+
+    def is_empty(self):
+        return len(self.stages) == 0
+
+    def for_video(self, video_path, cached_only=False):
+        # the pipeline with all stages bound to the video, see EnhancementStage.bind()
+        return EnhancementPipeline([stage.bind(video_path, cached_only) for stage in self.stages])
+
+    def passes(self):
+        """
+        the stages grouped into passes over the frame, consecutive point operations are fused into one pass
+        """
+        passes = []
+        point_stages = []
+        for stage in self.stages:
+            if stage.point_operation:
+                point_stages.append(stage)
+                continue
+            if point_stages:
+                passes.append(FusedPointPass(point_stages))
+                point_stages = []
+            passes.append(StagePass(stage))
+        if point_stages:
+            passes.append(FusedPointPass(point_stages))
+        return passes
+
+    def run(self, frame, scale=1.0, cache=None, source_key=None):
+        """
+        applies all stages to the frame, the frame itself isn't changed
+        :param cache: optional FrameCache, the output of every pass is kept in it. The passes of the longest
+        prefix of the pipeline which was already run on the same frame are skipped.
+        :param source_key: identifies the frame (e.g. its frame_key()), needed to use the cache
+        """
+        passes = self.passes()
+        if cache is None or source_key is None:
+            image = frame
+            for enhancement_pass in passes:
+                image = enhancement_pass.apply(image, scale=scale)
+            return image
+
+        # each pass output is keyed by the frame and all stages up to and including the pass
+        keys = []
+        prefix = ()
+        for enhancement_pass in passes:
+            prefix += tuple(stage.key() for stage in enhancement_pass.stages)
+            keys.append((source_key, frame.shape, scale, prefix))
+
+        image = frame
+        start = 0
+        for i in range(len(passes) - 1, -1, -1):
+            cached = cache.get(keys[i])
+            if cached is not None:
+                image = cached
+                start = i + 1
+                break
+
+        for i in range(start, len(passes)):
+            image = passes[i].apply(image, scale=scale)
+            cache.put(keys[i], image)
+        return image
+
+    def runner(self, scale=1.0):
+        return PipelineRunner(self, scale)
+
+    def describe(self):
+        return [repr(stage) for stage in self.stages]
+
+    def to_dict(self):
+        return {"stages": [stage.to_dict() for stage in self.stages]}
+
+    @classmethod
+    def from_dict(cls, pipeline_dict):
+        stages = []
+        for stage_dict in pipeline_dict.get("stages", []):
+            params = dict(stage_dict)
+            name = params.pop("stage")
+            if name not in STAGES:
+                raise ValueError("unknown enhancement stage: {}".format(name))
+            stages.append(STAGES[name](**params))
+        return cls(stages)
+
+
+class PipelineRunner:
+    """
+    runs a pipeline over many frames of the same size (e.g. a whole video). The operators of all passes are built
+    once, so no tables, kernels or CLAHE objects are created per frame and all output buffers are reused.
+    The returned image is only valid until the next call of run().
+    """
+
+    def __init__(self, pipeline, scale=1.0):
+        self.operators = [enhancement_pass.operator(scale) for enhancement_pass in pipeline.passes()]
+
+    def run(self, frame):
+        image = frame
+        for operator in self.operators:
+            image = operator(image)
+        return image
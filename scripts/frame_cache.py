@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+
+def frame_key(video_path, frame_index, colour_mode="gray"):
+    return (video_path, int(frame_index), colour_mode)
+
+
+class FrameCache:
+    """
+    least recently used cache of images, e.g. decoded frames keyed by (video path, frame index, colour mode) or
+    the outputs of the preview pipeline passes. Any hashable key works. The cache holds at most budget_mb
+    megabytes of image data, older images are dropped first. Cached images are shared, so callers must not
+    modify them in place.
+    """
+
+    def __init__(self, budget_mb=256, name="frame cache"):
+        self.name = name
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def contains(self, key):
+        # doesn't count as hit or miss and doesn't change the eviction order
+        with self._lock:
+            return key in self._frames
+
+    def put(self, key, frame):
+        if frame is None or frame.nbytes > self.budget_bytes:
+            return
+        with self._lock:
+            old_frame = self._frames.pop(key, None)
+            if old_frame is not None:
+                self.size_bytes -= old_frame.nbytes
+            self._frames[key] = frame
+            self.size_bytes += frame.nbytes
+            self._evict()
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget_bytes = int(budget_mb * 1024 * 1024)
+            self._evict()
+
+    def _evict(self):
+        # must be called with the lock held
+        while self.size_bytes > self.budget_bytes and self._frames:
+            _, frame = self._frames.popitem(last=False)
+            self.size_bytes -= frame.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.size_bytes = 0
+
+    def stats_text(self):
+        return "{}: {} hits / {} misses, {:.1f} of {:.0f} MB used".format(
+            self.name, self.hits, self.misses, self.size_bytes / (1024 * 1024), self.budget_bytes / (1024 * 1024))
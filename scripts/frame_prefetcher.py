@@ -0,0 +1,152 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from scripts.frame_cache import frame_key
+from scripts.seek_index import get_seek_index
+from scripts.video_capture_pool import CapturePool
+
+
+class FramePrefetcher:
+    """
+    decodes frames around the current preview frame into the frame cache on one background thread, so that
+    stepping and scrubbing mostly hit the cache. The scrub direction and speed decide which frames are decoded:
+    - stepping forward: the next frames
+    - stepping backward: the GOP before the current frame, decoded forward from its keyframe
+    - scrubbing: frames further along the scrub direction, spaced like the last slider steps
+    The prefetcher uses its own video capture, pauses while the foreground decodes, only runs for
+    max_duty_cycle of the time and stops a plan once it has decoded max_prefetch_mb of frames.
+    :param frame_cache: FrameCache the decoded frames are put into
+    :param convert_frame: function applied to each decoded frame before it's cached (e.g. grayscale conversion)
+    :param colour_mode: colour mode part of the cache key
+    :param frames_ahead: maximum number of frames decoded ahead
+    :param max_frames_behind: maximum number of frames decoded behind the current frame
+    :param lookahead_seconds: frames the scrub would reach within this time are prefetched
+    :param max_prefetch_mb: memory decoded per plan before the prefetcher stops
+    :param max_duty_cycle: fraction of time the prefetch thread is allowed to decode
+    :param open_capture: function which opens a capture for a video path, see CapturePool
+    """
+
+    def __init__(self, frame_cache, convert_frame, colour_mode="gray", frames_ahead=12, max_frames_behind=60,
+                 lookahead_seconds=1.0, max_prefetch_mb=64, max_duty_cycle=0.5, open_capture=None):
+        self.frame_cache = frame_cache
+        self.convert_frame = convert_frame
+        self.colour_mode = colour_mode
+        self.frames_ahead = frames_ahead
+        self.max_frames_behind = max_frames_behind
+        self.lookahead_seconds = lookahead_seconds
+        self.max_prefetch_bytes = int(max_prefetch_mb * 1024 * 1024)
+        self.max_duty_cycle = max_duty_cycle
+        self.prefetched = 0
+
+        self.capture_pool = CapturePool(max_handles=1, open_capture=open_capture)
+        self._condition = threading.Condition()
+        self._plan = []             # (video path, frame index) still to decode, in decode order
+        self._plan_bytes = 0
+        self._foreground = 0        # number of foreground decodes in progress
+        self._last_request = None   # (video path, frame index, time)
+        self._thread = None
+
+    def note_request(self, video_path, frame_index, frame_count):
+        """
+        called for every preview request, replaces the current plan with frames around frame_index
+        """
+        now = time.monotonic()
+        with self._condition:
+            step, elapsed = 1, None
+            if self._last_request is not None and self._last_request[0] == video_path:
+                step = frame_index - self._last_request[1]
+                elapsed = now - self._last_request[2]
+            self._last_request = (video_path, frame_index, now)
+            if step == 0:
+                return
+
+            self._plan = [(video_path, index) for index in self._plan_frames(video_path, frame_index, step,
+                                                                             elapsed, frame_count)]
+            self._plan_bytes = 0
+            self._start_thread()
+            self._condition.notify_all()
+
+    def _plan_frames(self, video_path, frame_index, step, elapsed, frame_count):
+        stride = abs(step)
+        if elapsed is not None and elapsed > 0:
+            # frames/s of the scrub, only prefetch what it reaches within the lookahead time
+            speed = stride / elapsed
+            count = int(min(self.frames_ahead, max(2, speed * self.lookahead_seconds / stride)))
+        else:
+            count = self.frames_ahead
+
+        if step > 0:
+            frames = [frame_index + stride * i for i in range(1, count + 1)]
+        elif stride == 1:
+            # stepping backwards: decode the GOP before the frame forward from its keyframe, which is sequential
+            seek_index = get_seek_index(video_path)
+            start = seek_index.keyframe_before(frame_index - 1) if seek_index is not None else 0
+            start = max(start, frame_index - self.max_frames_behind, 0)
+            frames = list(range(start, frame_index))
+        else:
+            frames = [frame_index - stride * i for i in range(1, count + 1)]
+
+        return [index for index in frames if 0 <= index < frame_count]
+
+    @contextmanager
+    def foreground(self):
+        """
+        wrap foreground decodes with this, the prefetcher doesn't start new frames meanwhile
+        """
+        with self._condition:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._foreground -= 1
+                self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._plan = []
+            self._last_request = None
+        self.capture_pool.release_all()
+
+    def _start_thread(self):
+        # must be called with the condition held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="FramePrefetcher", daemon=True)
+            self._thread.start()
+
+    def _next_frame(self):
+        with self._condition:
+            while not self._plan or self._foreground:
+                self._condition.wait()
+            if self._plan_bytes >= self.max_prefetch_bytes:
+                self._plan = []
+                return None
+            return self._plan.pop(0)
+
+    def _run(self):
+        while True:
+            planned = self._next_frame()
+            if planned is None:
+                continue
+            video_path, frame_index = planned
+            key = frame_key(video_path, frame_index, self.colour_mode)
+            if self.frame_cache.contains(key):
+                continue
+
+            started = time.monotonic()
+            try:
+                with self.capture_pool.checkout(video_path) as capture:
+                    ret, frame = capture.read_frame(frame_index)
+                if ret:
+                    frame = self.convert_frame(frame)
+                    self.frame_cache.put(key, frame)
+                    self.prefetched += 1
+                    with self._condition:
+                        self._plan_bytes += frame.nbytes
+            except Exception as error:
+                print("prefetching frame {} of {} failed: {}".format(frame_index, video_path, error))
+
+            # leave the CPU to the foreground for the rest of the duty cycle
+            busy = time.monotonic() - started
+            time.sleep(busy * (1.0 - self.max_duty_cycle) / self.max_duty_cycle)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from scripts.video_metadata import get_metadata
+
+# decoded frames of the videos, stored as memory-mapped .npy files with a .json header next to them
+DEFAULT_STORE_DIR = os.path.join(str(Path.home()), ".videosmith", "frame_store")
+
+# one lock per store, so threads which need the same store build it only once
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def store_path(video_path, store_dir=DEFAULT_STORE_DIR, gray=False):
+    # path of the store without extension, the frames are in .npy, the header in .json
+    video_hash = hashlib.sha1(os.path.abspath(video_path).encode("utf-8")).hexdigest()
+    return os.path.join(store_dir, "{}_{}".format(video_hash, "gray" if gray else "bgr"))
+
+
+class FrameStore:
+    """
+    all decoded frames of a video in one memory-mapped array of shape (frames, height, width[, 3]). Frames are
+    read-only views into the mapping, so reading a frame neither decodes nor copies anything and any frame can
+    be reached without seeking.
+    """
+
+    def __init__(self, video_path, frames, fps, gray):
+        self.video_path = video_path
+        self.frames = frames
+        self.fps = fps
+        self.gray = gray
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame(self, index):
+        return self.frames[index]
+
+    def frame_range(self, start, stop):
+        # frames [start;stop) as one view
+        return self.frames[start:stop]
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    @classmethod
+    def load(cls, path, video_path):
+        """
+        returns the store at path (without extension), or None if it is missing or the video changed since
+        it was built
+        """
+        if not os.path.exists(path + ".json") or not os.path.exists(path + ".npy"):
+            return None
+        with open(path + ".json") as header_file:
+            header = json.load(header_file)
+        stat = os.stat(video_path)
+        if header["video_size"] != stat.st_size or header["video_mtime"] != stat.st_mtime:
+            return None
+        frames = np.load(path + ".npy", mmap_mode="r")
+        if list(frames.shape[1:]) != header["shape"][1:] or str(frames.dtype) != header["dtype"]:
+            return None
+        # the header has the number of frames which could be decoded, the array may have been allocated larger
+        return cls(video_path, frames[:header["frame_count"]], header["fps"], header["gray"])
+
+
+def get_store(video_path, gray=False, store_dir=DEFAULT_STORE_DIR):
+    """
+    returns the frame store of the video if one was built after the video was last changed, otherwise None.
+    For gray frames a colour store is used as well if there is no gray one, the frames then still need to
+    be converted but not decoded.
+    """
+    if not os.path.exists(video_path):
+        return None
+    for store_gray in ([True, False] if gray else [False]):
+        store = FrameStore.load(store_path(video_path, store_dir, store_gray), video_path)
+        if store is not None:
+            return store
+    return None
+
+
+def build_store(video_path, source, gray=False, store_dir=DEFAULT_STORE_DIR, progress_callback=None):
+    """
+    decodes all frames of the video once into a memory-mapped .npy file. Frames are decoded straight into the
+    mapping where the reader supports it.
+    :param video_path: path of the video
+    :param source: opened video reader at the first frame, decodes gray frames if gray is True
+    :param gray: store single channel frames, a third of the size of a colour store
+    :param store_dir: folder the stores are kept in
+    :param progress_callback: optional function called with the % of frames decoded
+    :return: FrameStore or None if the video couldn't be read or the disk is too full
+    """
+    path = store_path(video_path, store_dir, gray)
+    with _build_locks_lock:
+        lock = _build_locks.setdefault(path, threading.Lock())
+
+    with lock:
+        existing_store = get_store(video_path, gray, store_dir)
+        if existing_store is not None and existing_store.gray == gray:
+            return existing_store
+
+        metadata = get_metadata(video_path)
+        if not metadata.readable or not source.isOpened():
+            print("Error opening video stream or file")
+            return None
+
+        shape = (metadata.frame_count, metadata.height, metadata.width) + (() if gray else (3,))
+        os.makedirs(store_dir, exist_ok=True)
+        if int(np.prod(shape)) > shutil.disk_usage(store_dir).free * 0.9:
+            print("not enough disk space for the frame store of {} ({:.1f} GB)".format(
+                video_path, np.prod(shape) / 1024 ** 3))
+            return None
+
+        # write to a temporary file first, so an interrupted build is never taken for a finished store.
+        # Processes building the same store each write their own file, the last one replaces the others
+        temp_path = "{}_building_{}_{}".format(path, os.getpid(), threading.get_ident())
+        try:
+            frames = np.lib.format.open_memmap(temp_path + ".npy", mode="w+", dtype=np.uint8, shape=shape)
+            frame_index = 0
+            progress_step = max(1, metadata.frame_count // 50)
+            while frame_index < metadata.frame_count:
+                slot = frames[frame_index]
+                ret, frame = source.read(slot)
+                if not ret:
+                    break
+                if frame is not slot:
+                    slot[...] = frame
+                frame_index += 1
+                if progress_callback is not None and frame_index % progress_step == 0:
+                    progress_callback(int(100 * frame_index / metadata.frame_count))
+            frames.flush()
+            del frames
+
+            stat = os.stat(video_path)
+            header = {"shape": list(shape), "dtype": "uint8", "fps": metadata.fps, "frame_count": frame_index,
+                      "gray": gray, "video_size": stat.st_size, "video_mtime": stat.st_mtime}
+            with open(temp_path + ".json", "w") as header_file:
+                json.dump(header, header_file)
+            os.replace(temp_path + ".npy", path + ".npy")
+            os.replace(temp_path + ".json", path + ".json")
+        finally:
+            # a build which failed or was interrupted leaves nothing behind, after a build the files were moved
+            for extension in (".npy", ".json"):
+                if os.path.exists(temp_path + extension):
+                    os.remove(temp_path + extension)
+
+        return FrameStore.load(path, video_path)
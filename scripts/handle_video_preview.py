@@ -1,5 +1,29 @@
 import cv2
 
+from scripts.frame_cache import FrameCache, frame_key
+from scripts.frame_prefetcher import FramePrefetcher
+from scripts.video_capture_pool import CapturePool
+from scripts.video_metadata import cached_metadata, get_metadata
+from scripts.video_readers import open_reader
+
+# reader backend and its options used for the preview, see video_readers.READERS
+reader = "opencv"
+reader_options = {}
+
+
+def open_preview_reader(path):
+    # the preview is grayscale, so the reader decodes gray frames
+    return open_reader(path, reader, reader_options, gray=True)
+
+
+# open video captures shared by all preview updates
+capture_pool = CapturePool(max_handles=4, open_capture=open_preview_reader)
+# decoded grayscale preview frames, the budget is set from the main window
+frame_cache = FrameCache(budget_mb=256)
+# low resolution proxies which are ready, by video path. Only used while proxy mode is on
+proxies = {}
+use_proxies = False
+
 
 def handle_video_preview(videolist, selected_preview, preview_frame):
     """
@@ -18,65 +42,125 @@ def handle_video_preview(videolist, selected_preview, preview_frame):
 
 
 def convert_to_grayscale(image):
+    if image.ndim == 2:
+        # already decoded as grayscale
+        return image
 
     gray_frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     return gray_frame
 
 
-def set_default_preview(videolist, preview_frame, selected_video):
-    # load the original image
-    print("in handle_preview: ", videolist)
+# decodes frames around the current preview frame in the background
+prefetcher = FramePrefetcher(frame_cache, convert_to_grayscale, colour_mode="gray",
+                             open_capture=open_preview_reader)
 
-    cap = cv2.VideoCapture(videolist[selected_video-1])
 
-    # Check if camera opened successfully
-    if (cap.isOpened() == False):
-        print("Error opening video stream or file")
+def downscale_for_display(image, display_width, display_height):
+    """
+    shrinks the image to fit into the display size, keeping the aspect ratio. Images which already fit are
+    returned as they are.
+    :return: image, scale of the returned image relative to the input
+    """
+    scale = min(1.0, display_width / image.shape[1], display_height / image.shape[0])
+    if scale >= 1.0:
+        return image, 1.0
 
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    print('Frame count:', frame_count)
+    size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
 
-    cap.set(cv2.CAP_PROP_POS_FRAMES, preview_frame)
-    # Capture specified preview frame
-    _, frame = cap.read()
 
-    original = frame
+def set_use_proxies(enabled):
+    global use_proxies
+    use_proxies = enabled
 
-    # When everything done, release the video capture object
-    cap.release()
-    # Closes all the frames
-    #cv2.destroyAllWindows()
 
-    preview_image = convert_to_grayscale(original)
+def preview_source(videolist, selected_video):
+    # the preview reads the proxy of the video if proxy mode is on and the proxy is ready
+    video_path = videolist[selected_video-1]
+    if use_proxies and video_path in proxies:
+        return proxies[video_path]
+    return video_path
 
-    return preview_image, frame_count
 
+def preview_key(videolist, preview_frame, selected_video):
+    # identifies the decoded preview frame, for caches of results computed from it
+    return frame_key(preview_source(videolist, selected_video), preview_frame, "gray")
 
-def update_preview(videolist, preview_frame, selected_video):
+
+def set_default_preview(videolist, preview_frame, selected_video):
     # load the original image
-    cap = cv2.VideoCapture(videolist[selected_video-1])
+    print("in handle_preview: ", videolist)
+
+    preview_image, frame_count = update_preview(videolist, preview_frame, selected_video)
+    print('Frame count:', frame_count)
 
-    # Check if camera opened successfully
-    if (cap.isOpened() == False):
-        print("Error opening video stream or file")
+    return preview_image, frame_count
 
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    cap.set(cv2.CAP_PROP_POS_FRAMES, preview_frame)
-    # Capture specified preview frame
-    _, frame = cap.read()
+def get_cached_preview(videolist, preview_frame, selected_video):
+    """
+    returns the preview image and frame count if the frame was decoded before, otherwise None
+    """
+    video_path = preview_source(videolist, selected_video)
+    metadata = cached_metadata(videolist[selected_video-1])
+    preview_image = frame_cache.get(frame_key(video_path, preview_frame, "gray"))
+    if preview_image is None or metadata is None:
+        return None
 
-    original = frame
+    return preview_image, metadata.frame_count
 
-    # When everything done, release the video capture object
-    cap.release()
-    # Closes all the frames
-    #cv2.destroyAllWindows()
+
+def update_preview(videolist, preview_frame, selected_video):
+    video_path = preview_source(videolist, selected_video)
+    # frame count of the original video, the proxy has the same number of frames
+    frame_count = get_metadata(videolist[selected_video-1]).frame_count
+    # the capture stays open in the pool, so scrubbing doesn't re-open the video for every frame
+    with prefetcher.foreground(), capture_pool.checkout(video_path) as capture:
+        # Check if camera opened successfully
+        if (capture.is_opened() == False):
+            print("Error opening video stream or file")
+
+        # Capture specified preview frame
+        _, frame = capture.read_frame(preview_frame)
+
+    original = frame
 
     preview_image = convert_to_grayscale(original)
 
+    frame_cache.put(frame_key(video_path, preview_frame, "gray"), preview_image)
+
     return preview_image, frame_count
 
 
+def prefetch_around(videolist, preview_frame, selected_video):
+    # lets the prefetcher decode the frames the user is likely to look at next
+    metadata = cached_metadata(videolist[selected_video-1])
+    if metadata is not None:
+        prefetcher.note_request(preview_source(videolist, selected_video), preview_frame, metadata.frame_count)
+
 
+def set_reader(name, options=None):
+    """
+    switches the reader backend of the preview, captures opened with the old backend are closed
+    """
+    global reader, reader_options
+    reader = name
+    reader_options = dict(options or {})
+    prefetcher.clear()
+    capture_pool.release_all()
+    frame_cache.clear()
+
+
+def release_captures(video_path):
+    # the next preview of the video opens a new reader, e.g. once the frame store of the video is built
+    prefetcher.capture_pool.release(video_path)
+    capture_pool.release(video_path)
+
+
+def release_previews():
+    # close all video captures kept open for the preview and drop their cached frames
+    prefetcher.clear()
+    capture_pool.release_all()
+    frame_cache.clear()
+    proxies.clear()
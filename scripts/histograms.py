@@ -1,27 +1,66 @@
 import cv2
-import matplotlib.pyplot as plt
+import numpy as np
 
+# size of the drawn histogram plots, same as the old 4 x 4.5 inch figures at 100 dpi
+PLOT_WIDTH = 400
+PLOT_HEIGHT = 450
+# line colours (BGR) of the plotted channels
+GRAY_COLOUR = (180, 119, 31)
+CHANNEL_COLOURS = [(255, 0, 0), (0, 160, 0), (0, 0, 255)]
 
-def calculate_histogram(current_image):
-    # first convert frame to grayscale:
-    hist_original = cv2.calcHist(current_image,[0],None,[256],[0,256])
 
-    plt.plot(hist_original)
-    fig = plt.gcf()
-    fig.set_size_inches(4, 4.5)
-    fig.savefig("origHist.png", dpi=100)
-    plt.show()
-    plt.close()
+def histogram_counts(image, per_channel=False):
+    """
+    256 bin histogram of the image
+    :param image: grayscale or BGR image
+    :param per_channel: if True colour images get one histogram per channel, otherwise the image is converted
+    to grayscale first
+    :return: float32 array with shape (256,) or (channels, 256) for per channel histograms
+    """
+    if image.ndim == 2 or not per_channel:
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.calcHist([image], [0], None, [256], [0, 256]).ravel()
+    return np.stack([cv2.calcHist([image], [channel], None, [256], [0, 256]).ravel()
+                     for channel in range(image.shape[2])])
+
+
+def draw_histogram(counts, width=PLOT_WIDTH, height=PLOT_HEIGHT, colours=None):
+    """
+    draws the histogram counts as line plot straight into an image buffer
+    :param counts: array with shape (256,) or (channels, 256)
+    :param colours: one BGR colour per channel
+    :return: BGR uint8 image of the plot
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    if colours is None:
+        colours = [GRAY_COLOUR] if len(counts) == 1 else CHANNEL_COLOURS
+    plot = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    margin = 10
+    peak = max(counts.max(), 1.0)
+    xs = margin + np.arange(256) * (width - 2 * margin - 1) / 255.0
+    for channel_counts, colour in zip(counts, colours):
+        ys = height - margin - 1 - channel_counts / peak * (height - 2 * margin - 1)
+        points = np.round(np.stack([xs, ys], axis=1)).astype(np.int32)
+        cv2.polylines(plot, [points], False, colour, 1)
+
+    cv2.rectangle(plot, (margin - 1, margin - 1), (width - margin, height - margin), (0, 0, 0), 1)
+    return plot
 
-    plot_hist_orig = cv2.imread("origHist.png")
+
+def calculate_histogram(current_image):
+    hist_original = histogram_counts(current_image)
+    plot_hist_orig = draw_histogram(hist_original)
 
     histogram_calculated = True
-    return histogram_calculated, plot_hist_orig
+    return histogram_calculated, plot_hist_orig, hist_original
 
 
 def equalize_histogram(histogram_calculated, current_image, use_threshold, threshold_text):
     info = "histogram equalized"
     plot_hist_equ = None
+    hist_equalized = None
     gray_frame_equalized = None
     default_clip_limit = 40
 
@@ -30,16 +69,6 @@ def equalize_histogram(histogram_calculated, current_image, use_threshold, thres
 
     elif use_threshold != True:
         gray_frame_equalized = cv2.equalizeHist(current_image)
-        hist_equalized = cv2.calcHist(gray_frame_equalized,[0],None,[256],[0,256])
-
-        plt.plot(hist_equalized, "r-")
-        fig = plt.gcf()
-        fig.set_size_inches(4, 4.5)
-        fig.savefig("equHist.png", dpi=100)
-        plt.show()
-        plt.close()
-
-        plot_hist_equ = cv2.imread("equHist.png")
 
     elif use_threshold == True:
         if threshold_text == "CLAHE":
@@ -51,6 +80,10 @@ def equalize_histogram(histogram_calculated, current_image, use_threshold, thres
         else:
             gray_frame_equalized = gray_frame_equalized
 
+    if gray_frame_equalized is not None:
+        hist_equalized = histogram_counts(gray_frame_equalized)
+        plot_hist_equ = draw_histogram(hist_equalized, colours=[(0, 0, 255)])
+
     histogram_calculated = False
 
-    return info, gray_frame_equalized, histogram_calculated, plot_hist_equ
\ No newline at end of file
+    return info, gray_frame_equalized, histogram_calculated, plot_hist_equ, hist_equalized
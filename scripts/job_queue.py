@@ -0,0 +1,355 @@
+"""
+Job queue in a spool directory on a shared filesystem (e.g. NFS), so export workers on any number of machines
+can work through one batch of videos. Every job is one JSON file which moves between the state folders:
+
+    pending/  waiting to be claimed
+    claimed/  being exported, the file name has the id of the worker and its mtime is the lease
+    done/     exported, with the result of the export
+    failed/   failed max_attempts times, or the video is unreadable
+    logs/     output of every attempt of a job
+    tmp/      jobs while they move between states, recovered from there if their worker crashed
+
+Files are only moved with rename, which is atomic within one filesystem, so two workers can never claim the
+same job. Workers renew their lease by touching the claimed file, jobs with expired leases (crashed workers)
+are put back into pending. Every attempt exports into its own hidden folder in the output folder, only the
+worker which still owns the job once the export is done moves the outputs to their final place.
+"""
+import contextlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from scripts.enhancement_pipeline import EnhancementPipeline
+from scripts.save_enhanced_videos import export_videos, plan_export_workers
+
+STATES = ["pending", "claimed", "done", "failed"]
+
+
+def worker_id():
+    # unique on the cluster, no dots so it can be part of the claimed file name
+    return "{}-{}-{}".format(socket.gethostname().replace(".", "_"), os.getpid(), uuid.uuid4().hex[:6])
+
+
+class JobQueue:
+
+    def __init__(self, spool_dir, lease_seconds=300, max_attempts=3):
+        """
+        :param spool_dir: folder of the queue, shared by all workers
+        :param lease_seconds: a claimed job whose lease wasn't renewed for this long is given to another worker
+        :param max_attempts: jobs are moved to failed after this many attempts
+        """
+        self.spool_dir = spool_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for folder in STATES + ["tmp", "logs"]:
+            os.makedirs(os.path.join(spool_dir, folder), exist_ok=True)
+
+    def _path(self, state, name=""):
+        return os.path.join(self.spool_dir, state, name)
+
+    def _write(self, job, state, name):
+        # written into tmp first, so no worker ever reads a half written job
+        temp_path = self._path("tmp", "{}.{}.partial".format(job["id"], uuid.uuid4().hex))
+        with open(temp_path, "w") as job_file:
+            json.dump(job, job_file, indent=1)
+        os.replace(temp_path, self._path(state, name))
+
+    def _read(self, path):
+        with open(path) as job_file:
+            return json.load(job_file)
+
+    def now(self):
+        """
+        current time of the filesystem. Leases are compared to this instead of the local clock, so the clocks
+        of the machines don't need to be in sync
+        """
+        clock_path = self._path("tmp", ".clock")
+        with open(clock_path, "a"):
+            os.utime(clock_path, None)
+        return os.path.getmtime(clock_path)
+
+    def submit(self, video, output_folder, pipeline, crop=False, crop_start=0, crop_end=0, **options):
+        """
+        :param video: path of the video, must be readable by all workers
+        :param output_folder: folder the enhanced video is saved to, must be writable by all workers
+        :param pipeline: EnhancementPipeline
+        :param options: options of export_videos(), e.g. grayscale, writer, writer_options, reader
+        :return: id of the job
+        """
+        job_id = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+        job = {"id": job_id, "video": video, "output_folder": output_folder, "pipeline": pipeline.to_dict(),
+               "crop": crop, "crop_start": crop_start, "crop_end": crop_end, "options": options,
+               "attempts": 0, "submitted": time.time()}
+        self._write(job, "pending", job_id + ".json")
+        return job_id
+
+    def claim(self, worker):
+        """
+        claims the oldest pending job
+        :param worker: id of the claiming worker, see worker_id()
+        :return: (job, path of the claimed job file) or (None, None) if no job is pending
+        """
+        for name in sorted(os.listdir(self._path("pending"))):
+            if not name.endswith(".json"):
+                continue
+            job_id = name[:-len(".json")]
+            claimed_path = self._path("claimed", "{}.{}.json".format(job_id, worker))
+            try:
+                os.rename(self._path("pending", name), claimed_path)
+            except FileNotFoundError:
+                # another worker was faster
+                continue
+            # the lease starts now, not when the job was submitted
+            os.utime(claimed_path, None)
+            return self._read(claimed_path), claimed_path
+        return None, None
+
+    def renew(self, claimed_path):
+        """
+        :return: False if the lease was lost, i.e. the job was requeued
+        """
+        try:
+            os.utime(claimed_path, None)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def take(self, claimed_path):
+        """
+        takes the claimed job out of claimed, so nobody requeues it while its outputs are published and its
+        result is written. Ownership of the job is only certain after this.
+        :return: path of the taken job file for commit(), None if the lease was lost and the job belongs to
+                 another worker now
+        """
+        taken_path = self._path("tmp", os.path.basename(claimed_path))
+        try:
+            os.rename(claimed_path, taken_path)
+        except FileNotFoundError:
+            return None
+        # the age of files in tmp tells if the worker which moved them there crashed, see requeue_stale()
+        os.utime(taken_path, None)
+        return taken_path
+
+    def commit(self, job, taken_path, state, result):
+        # moves the taken job to its new state with the result of the export
+        job = dict(job, result=result)
+        self._write(job, state, job["id"] + ".json")
+        os.remove(taken_path)
+
+    def _exists(self, job_id):
+        # True if the job is in any of the state folders
+        if any(os.path.exists(self._path(state, job_id + ".json")) for state in ["pending", "done", "failed"]):
+            return True
+        return any(name.startswith(job_id + ".") for name in os.listdir(self._path("claimed")))
+
+    def _recover_orphans(self, now):
+        """
+        jobs are moved into tmp while their new state is written. A worker which crashed in between leaves
+        them there, such jobs are put back into claimed with their old mtime, so they are requeued like jobs
+        with an expired lease. Half written files of crashed workers are removed.
+        """
+        for name in os.listdir(self._path("tmp")):
+            temp_path = self._path("tmp", name)
+            try:
+                if not name.endswith((".json", ".partial")) or now - os.path.getmtime(temp_path) < self.lease_seconds:
+                    continue
+                if name.endswith(".partial"):
+                    os.remove(temp_path)
+                    continue
+                job = self._read(temp_path)
+                if self._exists(job["id"]):
+                    # the new state was written but the worker crashed before removing the old file
+                    os.remove(temp_path)
+                else:
+                    # only one worker wins the rename
+                    os.rename(temp_path, self._path("claimed", name))
+            except FileNotFoundError:
+                continue
+
+    def requeue_stale(self):
+        """
+        puts jobs whose lease expired back into pending, or into failed once they had max_attempts. Jobs left
+        in tmp by crashed workers are recovered as well.
+        :return: ids of the requeued jobs
+        """
+        now = self.now()
+        self._recover_orphans(now)
+        requeued = []
+        for name in os.listdir(self._path("claimed")):
+            claimed_path = self._path("claimed", name)
+            try:
+                if now - os.path.getmtime(claimed_path) < self.lease_seconds:
+                    continue
+                # only one worker wins the rename, so a job is never requeued twice
+                temp_path = self._path("tmp", name)
+                os.rename(claimed_path, temp_path)
+                os.utime(temp_path, None)
+            except FileNotFoundError:
+                continue
+            job = self._read(temp_path)
+            worker = name[len(job["id"]) + 1:-len(".json")]
+            # the outputs of the crashed worker are never published
+            shutil.rmtree(attempt_folder(job, worker), ignore_errors=True)
+            job["attempts"] += 1
+            job["last_error"] = "lease of {} expired".format(worker)
+            if job["attempts"] >= self.max_attempts:
+                job["result"] = {"status": "failed", "error": job["last_error"]}
+                self._write(job, "failed", job["id"] + ".json")
+            else:
+                self._write(job, "pending", job["id"] + ".json")
+            os.remove(temp_path)
+            requeued.append(job["id"])
+        return requeued
+
+    def retry_failed(self):
+        # moves all failed jobs back into pending with a fresh count of attempts
+        retried = []
+        for name in os.listdir(self._path("failed")):
+            failed_path = self._path("failed", name)
+            # named like a claimed job, so requeue_stale() can recover it if this process crashes
+            temp_path = self._path("tmp", "{}.retry.json".format(name[:-len(".json")]))
+            try:
+                os.rename(failed_path, temp_path)
+                os.utime(temp_path, None)
+            except FileNotFoundError:
+                continue
+            job = self._read(temp_path)
+            job["attempts"] = 0
+            job.pop("result", None)
+            self._write(job, "pending", name)
+            os.remove(temp_path)
+            retried.append(job["id"])
+        return retried
+
+    def status(self):
+        # number of jobs in every state
+        return {state: len([name for name in os.listdir(self._path(state)) if name.endswith(".json")])
+                for state in STATES}
+
+    def log_path(self, job):
+        return self._path("logs", job["id"] + ".log")
+
+
+def attempt_folder(job, worker):
+    """
+    hidden folder in the output folder which one attempt exports into. Only the worker which still owns the job
+    when the export is done moves the outputs to their final place, so a worker which lost its lease can never
+    overwrite or leave behind a half written output of the worker the job was given to.
+    """
+    return os.path.join(job["output_folder"], ".{}.{}".format(job["id"], worker))
+
+
+def publish_outputs(folder, output_folder):
+    # moves everything exported into folder to the output folder, replacing outputs of earlier runs
+    for name in os.listdir(folder):
+        output = os.path.join(output_folder, name)
+        if os.path.isdir(output) and not os.path.islink(output):
+            # image sequences are folders, which os.replace() can't replace if they aren't empty
+            shutil.rmtree(output)
+        os.replace(os.path.join(folder, name), output)
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_job(job, log_file, threads=None, output_folder=None):
+    """
+    exports the video of the job with the same engine as the GUI and the command line
+    :param log_file: open file the output of the export is written to
+    :param threads: cores available to the job, all cores if None
+    :param output_folder: folder the video is exported to, the output folder of the job if None
+    :return: (state, result) with state "done" or "failed"
+    """
+    options = dict(job["options"])
+    segments, enhance_workers = plan_export_workers(1, 1, threads, options.get("writer", "xvid"))
+    options.setdefault("segments", segments)
+    options.setdefault("enhance_workers", enhance_workers)
+    pipeline = EnhancementPipeline.from_dict(job["pipeline"])
+
+    start = time.time()
+    with contextlib.redirect_stdout(log_file):
+        skipped, failed, methods = export_videos(output_folder or job["output_folder"], [job["video"]], pipeline,
+                                                 job["crop"], job["crop_start"], job["crop_end"], **options)
+    result = {"seconds": time.time() - start, "host": socket.gethostname()}
+    if job["video"] in methods:
+        result.update(status="done", method=methods[job["video"]])
+        return "done", result
+    result.update(status="skipped" if skipped else "failed")
+    return "failed", result
+
+
+def run_worker(job_queue, worker=None, poll_seconds=10, exit_when_empty=False, max_jobs=None, threads=None,
+               event_callback=None):
+    """
+    claims and exports jobs until the queue is empty (exit_when_empty) or max_jobs were done. While a job is
+    exported a background thread renews its lease.
+    :param job_queue: JobQueue
+    :param worker: id of this worker, a new one if None
+    :param poll_seconds: time between two looks into an empty queue
+    :param threads: cores available to each job, all cores if None
+    :param event_callback: optional function called with (event, dict of values) for every claimed and
+                           finished job
+    :return: number of jobs finished by this worker
+    """
+    worker = worker or worker_id()
+    finished = 0
+
+    def event(name, **values):
+        if event_callback is not None:
+            event_callback(name, dict(values, worker=worker))
+
+    while max_jobs is None or finished < max_jobs:
+        for job_id in job_queue.requeue_stale():
+            event("requeued", job=job_id)
+        job, claimed_path = job_queue.claim(worker)
+        if job is None:
+            if exit_when_empty:
+                break
+            time.sleep(poll_seconds)
+            continue
+        event("claimed", job=job["id"], video=job["video"], attempt=job["attempts"] + 1)
+
+        lease_lost = threading.Event()
+        stop_renewing = threading.Event()
+
+        def renew_lease():
+            # renews a few times per lease, so a slow filesystem doesn't let it expire
+            while not stop_renewing.wait(job_queue.lease_seconds / 4):
+                if not job_queue.renew(claimed_path):
+                    lease_lost.set()
+                    return
+
+        renewer = threading.Thread(target=renew_lease, daemon=True)
+        renewer.start()
+        folder = attempt_folder(job, worker)
+        with open(job_queue.log_path(job), "a") as log_file:
+            log_file.write("--- attempt {} by {} at {}\n".format(job["attempts"] + 1, worker, time.ctime()))
+            try:
+                state, result = run_job(job, log_file, threads, folder)
+            except Exception as error:
+                log_file.write("export failed: {}\n".format(error))
+                state, result = "failed", {"status": "failed", "error": str(error)}
+        stop_renewing.set()
+        renewer.join()
+
+        result["worker"] = worker
+        if state == "failed" and result["status"] == "failed" and job["attempts"] + 1 < job_queue.max_attempts:
+            # try again later, possibly on another machine
+            state = "pending"
+            job = dict(job, attempts=job["attempts"] + 1, last_error=result.get("error", "export failed"))
+        taken_path = None if lease_lost.is_set() else job_queue.take(claimed_path)
+        if taken_path is None:
+            # the job belongs to another worker now, which exports it again
+            shutil.rmtree(folder, ignore_errors=True)
+            event("lease_lost", job=job["id"])
+            continue
+        if state == "done":
+            publish_outputs(folder, job["output_folder"])
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+        job_queue.commit(job, taken_path, state, result)
+        finished += 1
+        event("finished", job=job["id"], state=state, **result)
+    return finished
@@ -0,0 +1,73 @@
+"""
+Point operations map every pixel value on its own, so any chain of them is again a mapping of the 256 possible
+values. compile_lut() composes a chain into one table, which is then applied with a single cv2.LUT per frame.
+
+Operations are tuples of the operation name and its parameters:
+    ("gamma", gamma_value)          gamma_value in slider units, 10 = gamma 1.0
+    ("brightness", value)           value in [-255;255] is added to every pixel
+    ("contrast", value)             value in [-127;127], > 0 increases the contrast around mid gray
+    ("equalize", table)             histogram equalization mapping as a tuple of 256 values
+    ("invert",)
+    ("clip", low, high)             values are clipped to [low;high]
+"""
+from functools import lru_cache
+
+import numpy as np
+
+
+def _gamma(values, gamma_value):
+    gamma = max(gamma_value, 1) / 10  # slider is from 0 to 20, because minimum increment is 1
+    return ((np.clip(values, 0, 255) / 255.0) ** (1.0 / gamma)) * 255
+
+
+def _brightness(values, value):
+    return values + value
+
+
+def _contrast(values, value):
+    factor = 131 * (value + 127) / (127 * (131 - value))
+    return factor * (values - 127) + 127
+
+
+def _equalize(values, table):
+    table = np.asarray(table, dtype=np.float64)
+    return table[np.clip(np.round(values), 0, 255).astype(np.intp)]
+
+
+def _invert(values):
+    return 255 - values
+
+
+def _clip(values, low, high):
+    return np.clip(values, low, high)
+
+
+OPERATIONS = {
+    "gamma": _gamma,
+    "brightness": _brightness,
+    "contrast": _contrast,
+    "equalize": _equalize,
+    "invert": _invert,
+    "clip": _clip,
+}
+
+
+@lru_cache(maxsize=256)
+def compile_lut(operations):
+    """
+    composes the point operations into one lookup table. Intermediate values are kept as floats, so the chain is
+    only rounded once, but clipped to [0;255] after every operation like the images are when the operations run
+    one after the other. Tables are cached, the same chain is only compiled once.
+    :param operations: tuple of operation tuples, applied in order
+    :return: read-only uint8 array with 256 entries
+    """
+    values = np.arange(256, dtype=np.float64)
+    for operation in operations:
+        name, params = operation[0], operation[1:]
+        if name not in OPERATIONS:
+            raise ValueError("unknown point operation: {}".format(name))
+        values = np.clip(OPERATIONS[name](values, *params), 0, 255)
+
+    table = values.astype(np.uint8)
+    table.flags.writeable = False
+    return table
@@ -0,0 +1,83 @@
+import hashlib
+import os
+from pathlib import Path
+
+import cv2
+
+from scripts.video_metadata import get_metadata
+
+# low resolution copies of the loaded videos, only used for the interactive preview
+DEFAULT_PROXY_DIR = os.path.join(str(Path.home()), ".videosmith", "proxies")
+
+
+def proxy_path(video_path, proxy_dir=DEFAULT_PROXY_DIR, max_width=640):
+    video_hash = hashlib.sha1(os.path.abspath(video_path).encode("utf-8")).hexdigest()
+    return os.path.join(proxy_dir, "{}_{}.avi".format(video_hash, max_width))
+
+
+def get_proxy(video_path, proxy_dir=DEFAULT_PROXY_DIR, max_width=640):
+    """
+    returns the path of the proxy of the video if one was built after the video was last changed, otherwise None
+    """
+    path = proxy_path(video_path, proxy_dir, max_width)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(video_path):
+        return path
+    return None
+
+
+def build_proxy(video_path, proxy_dir=DEFAULT_PROXY_DIR, max_width=640, progress_callback=None):
+    """
+    transcodes the video into a downscaled MJPG video. MJPG only has intra frames, so every frame of the proxy
+    can be decoded without decoding the frames before it.
+    :param video_path: path of the full resolution video
+    :param proxy_dir: folder the proxies are stored in
+    :param max_width: width of the proxy, videos which are already smaller keep their size
+    :param progress_callback: optional function called with the % of frames transcoded
+    :return: path of the proxy or None if the video couldn't be read or the proxy couldn't be written
+    """
+    existing_proxy = get_proxy(video_path, proxy_dir, max_width)
+    if existing_proxy is not None:
+        return existing_proxy
+
+    metadata = get_metadata(video_path)
+    if not metadata.readable:
+        print("Error opening video stream or file")
+        return None
+
+    cap = cv2.VideoCapture(video_path)
+    frame_count = metadata.frame_count
+    frame_rate = metadata.fps
+    frame_width = metadata.width
+    frame_height = metadata.height
+
+    scale = min(1.0, max_width / frame_width)
+    proxy_size = (max(1, int(round(frame_width * scale))), max(1, int(round(frame_height * scale))))
+
+    os.makedirs(proxy_dir, exist_ok=True)
+    path = proxy_path(video_path, proxy_dir, max_width)
+    # write to a temporary file first, so an interrupted build is never taken for a finished proxy
+    temp_path = path[:-len(".avi")] + "_building.avi"
+    out = cv2.VideoWriter(temp_path, cv2.VideoWriter_fourcc(*'MJPG'), frame_rate, proxy_size)
+    if not out.isOpened():
+        # e.g. the proxy folder isn't writable, the video is previewed from the full resolution video
+        print("proxy of {} can't be written to {}".format(video_path, temp_path))
+        cap.release()
+        return None
+
+    frame_index = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if scale < 1.0:
+            frame = cv2.resize(frame, proxy_size, interpolation=cv2.INTER_AREA)
+        out.write(frame)
+        frame_index += 1
+        if progress_callback is not None and frame_count > 0 and frame_index % 100 == 0:
+            progress_callback(int(100 * frame_index / frame_count))
+
+    cap.release()
+    out.release()
+
+    os.replace(temp_path, path)
+    return path
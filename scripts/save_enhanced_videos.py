@@ -1,8 +1,349 @@
+import multiprocessing
 import os
+import queue
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import cv2
+import numpy as np
 
-def save_new_videos(output_folder, videolist, enhancements, crop, crop_start, crop_end, gamma, gamma_value, callback=None):
+from scripts.enhancement_pipeline import EnhancementPipeline, GammaStage
+from scripts.seek_index import load_seek_index, seek
+from scripts.staged_export import StagedFrameProcessor, writer_frame
+from scripts.video_metadata import get_metadata, probe_video
+from scripts.video_readers import READERS, open_reader
+from scripts.video_writers import WRITERS, create_writer
+
+filename_add = "_enh"
+
+
+def output_path(output_folder, video, extension=".avi"):
+    # get the videoname, also for relative paths without a folder:
+    filename = os.path.splitext(os.path.basename(str(video)))[0]
+    videoname = filename + filename_add
+    return os.path.join(output_folder, videoname) + extension
+
+
+def frame_range(frame_count, crop, crop_start, crop_end):
+    """
+    frames of the video which are exported, shared by trimming and segment splitting
+    :param crop: if False the entire video
+    :param crop_start: number of frames cropped off at the start
+    :param crop_end: number of frames cropped off at the end
+    :return: (first frame, frame after the last frame)
+    """
+    if crop != True:
+        return 0, frame_count
+    start = min(max(0, crop_start), frame_count)
+    stop = max(start, frame_count - max(0, crop_end))
+    return start, stop
+
+
+def _open_writer(output_name, metadata, grayscale=False, writer="xvid", writer_options=None, **extra_options):
+    options = dict(writer_options or {}, **extra_options)
+    return create_writer(writer, **options).open(output_name, metadata.fps, (metadata.width, metadata.height),
+                                                 is_color=not grayscale)
+
+
+def _encode_range(video, output_name, pipeline, metadata, start, stop, progress_callback=None, enhance_workers=1,
+                  grayscale=False, writer="xvid", writer_options=None, reader="opencv", reader_options=None,
+                  **extra_options):
+    """
+    enhances the frames [start;stop) of the video and writes them to output_name
+    :param grayscale: frames are decoded as grayscale (or converted once after decoding) and written to a single
+                      channel video
+    :param writer: name of the writer backend, see video_writers.WRITERS
+    :param writer_options: options of the writer backend
+    :param reader: name of the reader backend, see video_readers.READERS
+    :param reader_options: options of the reader backend, e.g. {"threads": 4}
+    :return: the released writer and reader, with the statistics of the written and decoded frames
+    """
+    # create a video reader and a video write object
+    cap = open_reader(video, reader, reader_options, gray=grayscale)
+    out = _open_writer(output_name, metadata, grayscale, writer, writer_options, **extra_options)
+
+    if start > 0:
+        seek(cap, start, load_seek_index(video))
+
+    # read in frame by frame and apply enhancements, then save video
+    try:
+        if enhance_workers > 1:
+            # decoding, enhancing and encoding overlap
+            StagedFrameProcessor(pipeline, workers=enhance_workers, grayscale=grayscale).run(
+                cap, out, stop - start, progress_callback=progress_callback, frame_count=stop - start)
+        else:
+            _process_frames(cap, out, pipeline, stop - start, progress_callback, grayscale)
+    finally:
+        cap.release()
+        out.release()
+    return out, cap
+
+
+def save_video(video, output_folder, pipeline, crop, crop_start, crop_end, progress_callback=None, enhance_workers=1,
+               segments=1, min_segment_frames=500, grayscale=False, writer="xvid", writer_options=None,
+               reader="opencv", reader_options=None):
+    """
+    reads in the frames of one video within the crop range one-by-one, applies the pipeline and saves the
+    video to the output folder.
+    :param video: filepath of the video
+    :param pipeline: EnhancementPipeline applied to every frame
+    :param progress_callback: optional function called with the % of frames of the video written
+    :param enhance_workers: with more than 1, decoding, enhancement (on that many threads) and encoding run
+                            at the same time, see StagedFrameProcessor
+    :param segments: with more than 1, the frame range is split into that many segments which are encoded in
+                     parallel and joined afterwards, see save_video_segmented(). Only used if the segments can
+                     be joined without a second lossy encode, see can_join_losslessly()
+    :param min_segment_frames: videos are only split into segments of at least this many frames
+    :param grayscale: if True every stage works on one channel and a grayscale video is written
+    :param writer: name of the writer backend (codec/container or image sequence), see video_writers.WRITERS
+    :param writer_options: options of the writer backend, e.g. {"codec": "libx265"} for the ffmpeg writer
+    :param reader: name of the reader backend which decodes the video, see video_readers.READERS
+    :param reader_options: options of the reader backend, e.g. {"threads": 4} for the ffmpeg reader
+    :return: (path of the saved video, how it was exported incl. writer statistics), None if the video is unreadable
+    """
+    # metadata was probed when the videos were loaded, unreadable videos are skipped
+    metadata = get_metadata(video)
+    if not metadata.readable:
+        print("skipping {}: {}".format(video, metadata.error))
+        return None
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    # set output video length:
+    start, stop = frame_range(metadata.frame_count, crop, crop_start, crop_end)
+
+    # stages which depend on the whole video (e.g. video level equalization) are resolved per video
+    video_pipeline = pipeline.for_video(video)
+
+    same_container = os.path.splitext(video)[1].lower() == WRITERS[writer].extension
+    if video_pipeline.is_empty() and not grayscale and same_container:
+        # nothing to enhance and the writer has the container of the video, the frames can be copied
+        if (start, stop) == (0, metadata.frame_count):
+            output_name = output_path(output_folder, video, os.path.splitext(video)[1])
+            shutil.copyfile(video, output_name)
+            method = "copy"
+        else:
+            output_name, method = trim_video(video, output_folder, metadata, start, stop, writer, writer_options,
+                                             reader, reader_options)
+        if progress_callback is not None:
+            progress_callback(100)
+        print("videoname: ", output_name, "(" + method + ")")
+        return output_name, method
+
+    output_name = output_path(output_folder, video, WRITERS[writer].extension)
+    print("videoname: ", output_name)
+
+    # an empty pipeline only converts the video to the format of the writer
+    method = "re-encode" if video_pipeline.is_empty() else "enhance"
+    segments = min(segments, (stop - start) // max(1, min_segment_frames))
+    if segments > 1 and not can_join_losslessly(writer):
+        segments = 1
+    if segments > 1:
+        stats = save_video_segmented(video, output_name, video_pipeline, metadata, start, stop, segments,
+                                     progress_callback=progress_callback, enhance_workers=enhance_workers,
+                                     grayscale=grayscale, writer=writer, writer_options=writer_options,
+                                     reader=reader, reader_options=reader_options)
+        return output_name, "{} ({} segments, {})".format(method, segments, stats)
+    out, cap = _encode_range(video, output_name, video_pipeline, metadata, start, stop,
+                             progress_callback=progress_callback, enhance_workers=enhance_workers,
+                             grayscale=grayscale, writer=writer, writer_options=writer_options, reader=reader,
+                             reader_options=reader_options)
+    return output_name, "{} ({}, {})".format(method, cap.stats_text(), out.stats_text())
+
+
+def trim_video(video, output_folder, metadata, start, stop, writer="xvid", writer_options=None, reader="opencv",
+               reader_options=None):
+    """
+    cuts the frames [start;stop) out of the video without enhancing them. If the range starts on a keyframe
+    and ffmpeg is on the PATH, the encoded frames are copied, so nothing is decoded at all. Otherwise the
+    capture seeks to start (decoding only from the keyframe before it) and the range is re-encoded.
+    :return: (path of the trimmed video, how it was trimmed)
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    # the first frame is always a keyframe, only later starts need the seek index to tell
+    video_seek_index = load_seek_index(video) if start > 0 else None
+    on_keyframe = start == 0 or (video_seek_index is not None and video_seek_index.keyframe_before(start) == start)
+    if ffmpeg is not None and on_keyframe:
+        start_seconds = 0.0
+        if start > 0:
+            position = int(np.searchsorted(video_seek_index.keyframes, start))
+            start_seconds = video_seek_index.timestamps[position] / 1000.0
+        output_name = output_path(output_folder, video, os.path.splitext(video)[1])
+        result = subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-ss", "{:.6f}".format(start_seconds),
+                                 "-i", video, "-map", "0:v:0", "-frames:v", str(stop - start), "-c", "copy", "-an",
+                                 output_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # only trust the copy if it has exactly the frames of the range
+        if result.returncode == 0 and probe_video(output_name).frame_count == stop - start:
+            return output_name, "trim (stream copy)"
+        print("ffmpeg trim of {} not frame exact, re-encoding the range".format(video))
+        if os.path.exists(output_name):
+            os.remove(output_name)
+
+    output_name = output_path(output_folder, video, WRITERS[writer].extension)
+    out, cap = _encode_range(video, output_name, EnhancementPipeline(), metadata, start, stop, writer=writer,
+                             writer_options=writer_options, reader=reader, reader_options=reader_options)
+    return output_name, "trim ({}, {})".format(cap.stats_text(), out.stats_text())
+
+
+def save_video_segmented(video, output_name, pipeline, metadata, start, stop, segments, progress_callback=None,
+                         enhance_workers=1, grayscale=False, writer="xvid", writer_options=None, reader="opencv",
+                         reader_options=None):
+    """
+    splits the frame range into segments, encodes them in parallel into temporary files (each worker seeks to
+    the start of its segment) and joins them into output_name. Image sequences need no join, every segment
+    writes its frames with their final numbers straight into the output folder.
+    OpenCV releases the GIL while decoding, enhancing and encoding, so the segments run on threads.
+    :return: statistics of the writers of all segments
+    """
+    bounds = [start + (stop - start) * i // segments for i in range(segments + 1)]
+    extension = WRITERS[writer].extension
+    image_sequence = extension == ""
+    segment_folder = output_name[:len(output_name) - len(extension)] + "_segments"
+    if image_sequence:
+        segment_names = [output_name] * segments
+        segment_options = [{"start_number": bounds[i] - start} for i in range(segments)]
+    else:
+        os.makedirs(segment_folder, exist_ok=True)
+        segment_names = [os.path.join(segment_folder, "segment_{:04d}{}".format(i, extension))
+                         for i in range(segments)]
+        segment_options = [{} for _ in range(segments)]
+
+    progress = [0] * segments
+    progress_lock = threading.Lock()
+
+    def segment_progress(i, percent):
+        with progress_lock:
+            progress[i] = percent
+            merged = int(sum(progress) / segments)
+        if progress_callback is not None:
+            progress_callback(merged)
+
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(_encode_range, video, segment_names[i], pipeline, metadata, bounds[i],
+                                       bounds[i + 1], lambda percent, i=i: segment_progress(i, percent),
+                                       enhance_workers, grayscale, writer, writer_options, reader, reader_options,
+                                       **segment_options[i])
+                       for i in range(segments)]
+            # result() raises the error of a failed segment
+            writers = [future.result()[0] for future in futures]
+
+        if not image_sequence:
+            join_segments(segment_names, output_name, metadata, grayscale, writer, writer_options)
+    finally:
+        shutil.rmtree(segment_folder, ignore_errors=True)
+
+    frames = sum(out.frames_written for out in writers)
+    seconds = sum(out.write_seconds for out in writers)
+    if image_sequence:
+        size = sum(out.bytes_written for out in writers)
+    else:
+        size = os.path.getsize(output_name)
+    return "{}: {} frames, {:.1f} fps per segment, {:.1f} MB".format(
+        writer, frames, frames / seconds if seconds > 0 else 0.0, size / (1024 * 1024))
+
+
+def can_join_losslessly(writer):
+    """
+    segments are only worth encoding in parallel if joining them doesn't encode the frames a second time with
+    loss: ffmpeg concatenates the streams as they are, image sequences need no join and lossless writers
+    can be decoded and written again without loss
+    """
+    return shutil.which("ffmpeg") is not None or WRITERS[writer].extension == "" or WRITERS[writer].lossless
+
+
+def join_segments(segment_names, output_name, metadata, grayscale=False, writer="xvid", writer_options=None):
+    """
+    joins the segment videos into one. With ffmpeg on the PATH the streams are concatenated without
+    re-encoding. Otherwise (lossless writers only, see can_join_losslessly()) the segments are decoded and
+    written again through OpenCV, which can't copy encoded frames from one file into another. If the concat
+    fails, only segments of lossless writers are joined through OpenCV, the others would lose quality.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        list_path = os.path.join(os.path.dirname(segment_names[0]), "segments.txt")
+        with open(list_path, "w") as list_file:
+            for segment_name in segment_names:
+                # the concat demuxer needs single quotes in file names escaped
+                list_file.write("file '{}'\n".format(os.path.abspath(segment_name).replace("'", "'\\''")))
+        result = subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                                 "-c", "copy", output_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode == 0:
+            return "concat"
+        error = result.stderr.decode(errors="replace")
+        if not WRITERS[writer].lossless:
+            raise RuntimeError("ffmpeg concat of the segments failed: " + error)
+        print("ffmpeg concat failed, joining segments with OpenCV: " + error)
+
+    out = _open_writer(output_name, metadata, grayscale, writer, writer_options)
+    frame = None
+    gray_frame = None
+    for segment_name in segment_names:
+        cap = cv2.VideoCapture(segment_name)
+        while True:
+            ret, frame = cap.read(frame)
+            if not ret:
+                break
+            if grayscale:
+                # grayscale videos are decoded as BGR
+                gray_frame = writer_frame(frame, grayscale, dst=gray_frame)
+                out.write(gray_frame)
+            else:
+                out.write(frame)
+        cap.release()
+    out.release()
+    return "re-encode"
+
+
+def _process_frames(cap, out, pipeline, frame_limit, progress_callback=None, grayscale=False):
+    # the runner builds all operators once, frame and output buffers are reused for the whole video
+    runner = pipeline.runner()
+    frame = None
+    gray_frame = None
+    converted_frame = None
+    counter = 0
+    progress_step = max(1, frame_limit // 50)
+    while counter < frame_limit:
+        ret, frame = cap.read(frame)
+        if ret != True:
+            break
+        counter += 1
+
+        if grayscale and frame.ndim == 3:
+            # converted once, all stages then work on a single channel
+            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray_frame)
+            enh_frame = runner.run(gray_frame)
+        else:
+            # colour frames, or gray frames straight from the reader
+            enh_frame = runner.run(frame)
+
+        # write frame to video:
+        converted = writer_frame(enh_frame, grayscale, dst=converted_frame)
+        if converted is not enh_frame:
+            converted_frame = converted
+        out.write(converted)
+
+        if progress_callback is not None and counter % progress_step == 0:
+            progress_callback(min(100, int(100 * counter / frame_limit)))
+
+    return counter
+
+
+def _save_video_worker(video, output_folder, pipeline_dict, crop, crop_start, crop_end, progress_queue,
+                       enhance_workers, segments, grayscale, writer, writer_options, reader, reader_options):
+    # runs in a worker process, progress is sent back as (video, %) through the queue
+    pipeline = EnhancementPipeline.from_dict(pipeline_dict)
+    return save_video(video, output_folder, pipeline, crop, crop_start, crop_end,
+                      progress_callback=lambda percent: progress_queue.put((video, percent)),
+                      enhance_workers=enhance_workers, segments=segments, grayscale=grayscale, writer=writer,
+                      writer_options=writer_options, reader=reader, reader_options=reader_options)
+
+
+def save_new_videos(output_folder, videolist, enhancements, crop, crop_start, crop_end, gamma, gamma_value, callback=None,
+                    pipeline=None, workers=1, enhance_workers=1, segments=1, grayscale=False, writer="xvid",
+                    writer_options=None, reader="opencv", reader_options=None):
     """
     this function reads in video by video. For each video frames within the crop range are read in one-by-one,
     enhancements are applied and then the video is saved to the selected output location.
@@ -14,94 +355,174 @@ def save_new_videos(output_folder, videolist, enhancements, crop, crop_start, cr
     :param crop_start:
     :param crop_end:
     :param callback:
-    :return: Info message that saving of videos was successful
+    :param pipeline: EnhancementPipeline applied to every frame, the same one the preview shows. If None, only gamma
+                     is applied if gamma is True.
+    :param workers: number of videos exported at the same time in separate processes. With 1 all videos are
+                    exported one after another in the calling thread.
+    :param enhance_workers: enhancement threads within each video, see save_video()
+    :param segments: number of segments long videos are split into and encoded in parallel, see save_video()
+    :param grayscale: if True the videos are processed and saved as single channel grayscale videos
+    :param writer: name of the writer backend, see video_writers.WRITERS
+    :param writer_options: options of the writer backend
+    :param reader: name of the reader backend, see video_readers.READERS
+    :param reader_options: options of the reader backend, e.g. {"threads": 4}
+    :return: Info message that saving of videos was successful, followed by one line per video telling how it was
+             exported (copy, trim, enhance)
     """
+    if pipeline is None:
+        pipeline = EnhancementPipeline([GammaStage(gamma_value)] if gamma == True else [])
+
+    skipped, failed, methods = export_videos(output_folder, videolist, pipeline, crop, crop_start, crop_end,
+                                             callback=callback, workers=workers, enhance_workers=enhance_workers,
+                                             segments=segments, grayscale=grayscale, writer=writer,
+                                             writer_options=writer_options, reader=reader,
+                                             reader_options=reader_options)
+    return export_summary(output_folder, videolist, skipped, failed, methods)
+
+
+def plan_export_workers(export_workers, video_count, cpu_count=None, writer="xvid"):
+    """
+    with fewer videos than export workers, the spare workers encode segments of long videos in parallel
+    (only if the segments can be joined without loss, see can_join_losslessly()) and cores which are still
+    free enhance the frames of each segment in parallel
+    :param export_workers: number of videos exported at the same time
+    :param video_count: number of videos to export
+    :param writer: name of the writer backend the videos are exported with
+    :return: (segments per video, enhancement threads per segment)
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    videos_at_once = max(1, min(export_workers, video_count))
+    segments = 1
+    if can_join_losslessly(writer):
+        segments = max(1, export_workers // max(1, video_count))
+    enhance_workers = max(1, cpu_count // (videos_at_once * segments))
+    return segments, enhance_workers
+
+
+def export_videos(output_folder, videolist, pipeline, crop, crop_start, crop_end, callback=None, workers=1,
+                  enhance_workers=1, segments=1, grayscale=False, writer="xvid", writer_options=None,
+                  reader="opencv", reader_options=None):
+    """
+    exports all videos with the pipeline, see save_new_videos() for the parameters. A failing video doesn't
+    stop the others.
+    :return: lists of skipped (unreadable) and failed videos, dict of how each exported video was exported
+    """
+    if writer not in WRITERS:
+        raise ValueError("unknown video writer: {}".format(writer))
+    if reader not in READERS:
+        raise ValueError("unknown video reader: {}".format(reader))
 
     # make output folder if it doesn't exist yet
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    filename_add = "_enh"
-
-    for i, video in enumerate(videolist):
-        # create a video capture object
-        cap = cv2.VideoCapture(video)
-
-        # Check if camera opened successfully
-        if (cap.isOpened() == False):
-            print("Error opening video stream or file")
-
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_rate = cap.get(cv2.CAP_PROP_FPS)
-        duration = frame_count/frame_rate
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-        # get the videoname:
-        #print("video: ", video)
-        filename = str(video).rsplit("/", 1)[1]
-        filename = filename.rsplit(".", 1)[0]
-        #print("filename: ", filename)
-        videoname = filename + filename_add
-        print("videoname: ", videoname)
-
-        # create a video write object
-        output_name = os.path.join(output_folder, videoname) + ".avi"
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        out = cv2.VideoWriter(output_name, fourcc, frame_rate, (frame_width, frame_height))
-
-        # set output video length:
-        if crop == True:
-            framerange = [crop_start, crop_end]
-            cap.set(1, crop_start)
-        else:   # all frames
-            framerange = [0, frame_count]
-
-        # read in frame by frame and apply enhancements, then save video
-        counter = 0
-        while(cap.isOpened()):
-            counter += 1
-            ret, frame = cap.read()
-            if ret == True:
-
-                if gamma == True:
-                    gamma_frame = adjust_gamma(frame, gamma_value)
-                    enh_frame = gamma_frame
-                else:
-                    enh_frame = frame
-
-                # write frame to video:
-                if crop == True:
-                    if counter > (frame_count-crop_end):
-                        break   # stop writing to video once desired crop-off end reached
-                    else:
-                        out.write(enh_frame)
+    skipped = []
+    failed = []
+    methods = {}
+
+    if workers <= 1 or len(videolist) <= 1:
+        last_emitted = [-1]
+
+        def emit(merged):
+            if callback is not None and merged != last_emitted[0]:
+                callback.emit(merged)
+                last_emitted[0] = merged
+
+        for i, video in enumerate(videolist):
+            def video_progress(percent, i=i):
+                # the videos before this one are done, merged into one % like in the process pool
+                emit(int((100 * i + percent) / len(videolist)))
+
+            try:
+                result = save_video(video, output_folder, pipeline, crop, crop_start, crop_end,
+                                    progress_callback=video_progress, enhance_workers=enhance_workers,
+                                    segments=segments, grayscale=grayscale, writer=writer,
+                                    writer_options=writer_options, reader=reader, reader_options=reader_options)
+                if result is None:
+                    skipped.append(video)
                 else:
-                    out.write(enh_frame)
+                    methods[video] = result[1]
+            except Exception as error:
+                print("export of {} failed: {}".format(video, error))
+                failed.append(video)
 
-            else:
-                break
+            # track progress for files:
+            emit(int(100 * (i + 1) / len(videolist)))
+    else:
+        skipped, failed, methods = _save_videos_parallel(output_folder, videolist, pipeline, crop, crop_start,
+                                                         crop_end, callback, workers, enhance_workers, segments,
+                                                         grayscale, writer, writer_options, reader,
+                                                         reader_options)
+    return skipped, failed, methods
 
-            #print("Counter: ", counter)
 
-        # track progress for files:
-        if callback is not None:
-            callback.emit(int(100 * (i / len(videolist))))
+def export_summary(output_folder, videolist, skipped, failed, methods):
+    # first line tells if all videos were saved, then one line per video with the export path it took
+    message = ""
+    if skipped:
+        message += ", {} unreadable videos skipped: {}".format(len(skipped), ", ".join(skipped))
+    if failed:
+        message += ", {} videos failed: {}".format(len(failed), ", ".join(failed))
+    if message:
+        message = "enhanced videos saved to {}{}".format(output_folder, message)
+    else:
+        message = "all enhanced videos saved successfully to {}".format(output_folder)
+    for video in videolist:
+        if video in methods:
+            message += "\n- {}: {}".format(os.path.basename(video), methods[video])
+    return message
 
-        cap.release()
-        out.release()
 
-    return "all enhanced videos saved successfully to {}".format(output_folder)
+def _save_videos_parallel(output_folder, videolist, pipeline, crop, crop_start, crop_end, callback, workers,
+                          enhance_workers, segments, grayscale, writer, writer_options, reader, reader_options):
+    """
+    exports the videos in a process pool. The progress of all videos is merged into one %, a failing video
+    doesn't stop the others.
+    :return: lists of skipped (unreadable) and failed videos, dict of how each exported video was exported
+    """
+    skipped = []
+    failed = []
+    methods = {}
+    progress = {video: 0 for video in videolist}
+    last_emitted = -1
+    # stages which depend on the whole video are resolved here once, so the statistics accumulated in this
+    # process (e.g. by the GUI) are used and the worker processes don't read the videos a second time
+    pipeline_dicts = {video: pipeline.for_video(video).to_dict() for video in videolist}
+
+    # spawn instead of fork, the GUI process has Qt and decoder threads running
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        progress_queue = manager.Queue()
+        with ProcessPoolExecutor(max_workers=min(workers, len(videolist)), mp_context=context) as executor:
+            futures = {executor.submit(_save_video_worker, video, output_folder, pipeline_dicts[video], crop, crop_start,
+                                       crop_end, progress_queue, enhance_workers, segments, grayscale, writer,
+                                       writer_options, reader, reader_options): video
+                       for video in videolist}
+            pending = set(futures)
+            while pending:
+                try:
+                    video, percent = progress_queue.get(timeout=0.2)
+                    progress[video] = percent
+                except queue.Empty:
+                    pass
 
+                for future in [future for future in pending if future.done()]:
+                    pending.discard(future)
+                    video = futures[future]
+                    progress[video] = 100
+                    try:
+                        result = future.result()
+                        if result is None:
+                            skipped.append(video)
+                        else:
+                            methods[video] = result[1]
+                    except Exception as error:
+                        print("export of {} failed: {}".format(video, error))
+                        failed.append(video)
 
-def adjust_gamma(image, gamma_value):
-    import numpy as np
-    # build a lookup table mapping the pixel values [0, 255] to
-    # their adjusted gamma values
-    gamma_value = gamma_value/10  # slider is from 0 to 20, because minimum increment is 1
+                merged = int(sum(progress.values()) / len(videolist))
+                if callback is not None and merged != last_emitted:
+                    callback.emit(merged)
+                    last_emitted = merged
 
-    invGamma = 1.0 / gamma_value
-    table = np.array([((i / 255.0) ** invGamma) * 255
-                      for i in np.arange(0, 256)]).astype("uint8")
-    # apply gamma correction using the lookup table
-    return cv2.LUT(image, table)
\ No newline at end of file
+    return skipped, failed, methods
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# used when the index can't be written next to the video (e.g. read-only lab drives)
+DEFAULT_CACHE_DIR = os.path.join(str(Path.home()), ".videosmith", "seek_index")
+INDEX_SUFFIX = ".seekidx.npz"
+
+# seek indices of all videos loaded or built so far, by video path
+_seek_indices = {}
+_seek_indices_lock = threading.Lock()
+
+
+class SeekIndex:
+    """
+    frame numbers and timestamps (ms) of all keyframes of a video, stored as sorted numpy arrays.
+    """
+
+    def __init__(self, keyframes, timestamps, frame_count):
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.frame_count = int(frame_count)
+
+    def keyframe_before(self, frame_index):
+        # last keyframe at or before frame_index, 0 if the index has no keyframes
+        position = np.searchsorted(self.keyframes, frame_index, side="right") - 1
+        if position < 0:
+            return 0
+        return int(self.keyframes[position])
+
+    def save(self, index_path, video_path):
+        stat = os.stat(video_path)
+        with open(index_path, "wb") as index_file:
+            np.savez(index_file, keyframes=self.keyframes, timestamps=self.timestamps,
+                     frame_count=self.frame_count, video_size=stat.st_size, video_mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, index_path, video_path):
+        """
+        returns the index stored at index_path, or None if it is missing or the video changed since it was built
+        """
+        if not os.path.exists(index_path):
+            return None
+        stat = os.stat(video_path)
+        with np.load(index_path) as data:
+            if int(data["video_size"]) != stat.st_size or float(data["video_mtime"]) != stat.st_mtime:
+                return None
+            return cls(data["keyframes"], data["timestamps"], int(data["frame_count"]))
+
+
+def index_paths(video_path, cache_dir=DEFAULT_CACHE_DIR):
+    # next to the video first, then in the cache directory
+    video_hash = hashlib.sha1(os.path.abspath(video_path).encode("utf-8")).hexdigest()
+    return [str(video_path) + INDEX_SUFFIX, os.path.join(cache_dir, video_hash + INDEX_SUFFIX)]
+
+
+def build_seek_index(video_path, progress_callback=None):
+    """
+    runs once through the video with grab() to find all keyframes. The capture is opened in raw mode,
+    so packets are only demuxed and no frame is decoded.
+    :param video_path: path of the video
+    :param progress_callback: optional function called with the % of frames scanned
+    :return: SeekIndex
+    """
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    if (cap.isOpened() == False):
+        print("Error opening video stream or file")
+        return None
+
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    keyframes = []
+    timestamps = []
+
+    frame_index = 0
+    while cap.grab():
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(frame_index)
+            timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+        frame_index += 1
+        if progress_callback is not None and frame_count > 0 and frame_index % 1000 == 0:
+            progress_callback(int(100 * frame_index / frame_count))
+
+    cap.release()
+
+    return SeekIndex(keyframes, timestamps, frame_index)
+
+
+def load_seek_index(video_path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    returns the seek index of the video from memory or from disk, never builds one. Used by the export, which
+    runs in processes which don't share the indices in memory with the GUI.
+    """
+    seek_index = get_seek_index(video_path)
+    if seek_index is not None:
+        return seek_index
+
+    for index_path in index_paths(video_path, cache_dir):
+        seek_index = SeekIndex.load(index_path, video_path)
+        if seek_index is not None:
+            with _seek_indices_lock:
+                _seek_indices[video_path] = seek_index
+            return seek_index
+    return None
+
+
+def load_or_build_seek_index(video_path, cache_dir=DEFAULT_CACHE_DIR, progress_callback=None):
+    """
+    returns the seek index of the video, loading it from disk or building and saving it if there is none yet
+    """
+    seek_index = load_seek_index(video_path, cache_dir)
+    if seek_index is not None:
+        return seek_index
+
+    seek_index = build_seek_index(video_path, progress_callback)
+    if seek_index is None:
+        return None
+    for index_path in index_paths(video_path, cache_dir):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+            seek_index.save(index_path, video_path)
+            break
+        except OSError:
+            continue
+
+    with _seek_indices_lock:
+        _seek_indices[video_path] = seek_index
+    return seek_index
+
+
+def get_seek_index(video_path):
+    # only returns indices which are already in memory, never builds one
+    with _seek_indices_lock:
+        return _seek_indices.get(video_path)
+
+
+def forget_seek_indices():
+    with _seek_indices_lock:
+        _seek_indices.clear()
+
+
+def seek(cap, frame_index, seek_index=None, max_decode_ahead=300, current_frame=-1):
+    """
+    positions cap so that the next read() returns frame_index. With a seek index the capture jumps to the
+    keyframe before frame_index and grabs forward from there, which is frame accurate also on codecs where
+    setting CAP_PROP_POS_FRAMES directly isn't.
+    :param cap: cv2.VideoCapture
+    :param frame_index: frame to seek to
+    :param seek_index: SeekIndex of the video or None to seek with CAP_PROP_POS_FRAMES
+    :param max_decode_ahead: maximum number of frames grabbed forward from the keyframe
+    :param current_frame: frame the next read() of cap would return, if known
+    """
+    if seek_index is None:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        return
+
+    keyframe = seek_index.keyframe_before(frame_index)
+    if keyframe <= current_frame <= frame_index:
+        # target is in the current GOP ahead of the decoder, no need to go back to the keyframe
+        start = current_frame
+    else:
+        start = keyframe
+
+    if frame_index - start > max_decode_ahead:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        return
+
+    if start != current_frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for _ in range(frame_index - start):
+        if not cap.grab():
+            break
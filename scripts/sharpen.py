@@ -25,20 +25,40 @@ def salt_pepper(prob, image):
       return output
 
 
-def sharpen(current_preview):
+def sharpen_kernel(scale=1.0):
+    """
+    3x3 sharpening kernel.
+    :param scale: size of the image relative to the full resolution frame. Sharpening a downscaled preview with
+                  the full strength kernel looks much harsher than sharpening the full frame and shrinking it,
+                  so the strength of the kernel is reduced by the same factor.
+    """
+    # Create our sharpening kernel, the sum of all values must equal to one for uniformity
+    kernel_sharpening = np.array([[-1, -1, -1],
+                                  [-1, 9, -1],
+                                  [-1, -1, -1]])
+
+    if scale < 1.0:
+        # identity + scale * (full strength kernel - identity), still sums up to one
+        identity = np.zeros((3, 3))
+        identity[1, 1] = 1
+        kernel_sharpening = identity + scale * (kernel_sharpening - identity)
+
+    return kernel_sharpening
+
+
+def sharpen(current_preview, scale=1.0):
+    """
+    sharpens the image with a 3x3 kernel.
+    :param current_preview: image
+    :param scale: size of the image relative to the full resolution frame, see sharpen_kernel()
+    :return: sharpened image
+    """
     image = current_preview
 
     # add salt and pepper noise
     # Call salt & pepper function with probability = 0.5
     #image_sp = salt_pepper(0.5, image)
 
-    print("sharpening")
-
-    # Create our sharpening kernel, the sum of all values must equal to one for uniformity
-    kernel_sharpening = np.array([[-1, -1, -1],
-                                  [-1, 9, -1],
-                                  [-1, -1, -1]])
-
-    sharpened_image = cv2.filter2D(image, -1, kernel_sharpening)
+    sharpened_image = cv2.filter2D(image, -1, sharpen_kernel(scale))
 
     return sharpened_image
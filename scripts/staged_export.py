@@ -0,0 +1,176 @@
+import queue
+import threading
+
+import cv2
+
+# end of stream marker passed through the queues
+_END = None
+
+
+def writer_frame(image, grayscale=False, dst=None):
+    """
+    converts the enhanced image to the format the video writer was opened with
+    :param grayscale: True for writers opened with isColor=False
+    :param dst: optional buffer for the converted frame
+    """
+    if grayscale and image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+    if not grayscale and image.ndim == 2:
+        # e.g. edge images, the colour video writer expects colour frames
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR, dst=dst)
+    return image
+
+
+class StagedFrameProcessor:
+    """
+    decodes, enhances and encodes the frames of one video at the same time: a decoder thread, a pool of
+    enhancement threads (each with its own PipelineRunner, so no operator state is shared) and a writer thread
+    which puts the frames back into order. The stages are joined by bounded queues, so a slow stage blocks the
+    ones before it instead of piling up decoded frames. Frames which wait in the writer for a slow frame before
+    them count as well: at most queue_size + workers frames are between the decoder and the writer.
+    """
+
+    def __init__(self, pipeline, workers=2, queue_size=8, grayscale=False, batch_size=4):
+        """
+        :param pipeline: EnhancementPipeline already bound to the video
+        :param workers: number of enhancement threads, OpenCV releases the GIL while it works on a frame
+        :param queue_size: maximum number of frames waiting between two stages
+        :param grayscale: frames are converted to grayscale before the pipeline, for writers with isColor=False
+        :param batch_size: number of frames the decoder thread reads at once, see VideoReaderBackend.read_batch()
+        """
+        self.pipeline = pipeline
+        self.grayscale = grayscale
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+        self._errors = []
+        self._stop = threading.Event()
+        self._in_flight = None
+
+    def run(self, cap, out, frame_limit=None, progress_callback=None, frame_count=0):
+        """
+        :param cap: opened video reader, positioned at the first frame to write
+        :param out: video writer
+        :param frame_limit: number of frames to write, None for all remaining frames
+        :param progress_callback: optional function called with the % of frame_count written
+        :return: number of frames written
+        """
+        decoded = queue.Queue(maxsize=self.queue_size)
+        enhanced = queue.Queue(maxsize=self.queue_size)
+        written = [0]
+        # released by the writer once a frame is written
+        self._in_flight = threading.Semaphore(self.queue_size + self.workers)
+
+        threads = [threading.Thread(target=self._decode, args=(cap, decoded, frame_limit), daemon=True)]
+        threads += [threading.Thread(target=self._enhance, args=(decoded, enhanced), daemon=True)
+                    for _ in range(self.workers)]
+        writer = threading.Thread(target=self._write, args=(enhanced, out, written, progress_callback, frame_count),
+                                  daemon=True)
+        for thread in threads:
+            thread.start()
+        writer.start()
+
+        for thread in threads:
+            thread.join()
+        # all enhancement threads are done, so nothing else is put into the queue after the end marker
+        self._put(enhanced, _END)
+        writer.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return written[0]
+
+    def _put(self, target_queue, item):
+        # blocks while the queue is full, unless another stage failed
+        while not self._stop.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _acquire(self):
+        # blocks while too many frames are in flight, unless another stage failed
+        while not self._stop.is_set():
+            if self._in_flight.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _get(self, source_queue):
+        while not self._stop.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _fail(self, error):
+        self._errors.append(error)
+        self._stop.set()
+
+    def _decode(self, cap, decoded, frame_limit):
+        try:
+            index = 0
+            while frame_limit is None or index < frame_limit:
+                count = self.batch_size if frame_limit is None else min(self.batch_size, frame_limit - index)
+                # every batch gets a new array, its frames are still in use by the later stages
+                frames = cap.read_batch(count)
+                if frames is None:
+                    break
+                for frame in frames:
+                    if not self._acquire() or not self._put(decoded, (index, frame)):
+                        return
+                    index += 1
+                if len(frames) < count:
+                    break
+        except Exception as error:
+            self._fail(error)
+        finally:
+            # one end marker for each enhancement thread
+            for _ in range(self.workers):
+                self._put(decoded, _END)
+
+    def _enhance(self, decoded, enhanced):
+        try:
+            runner = self.pipeline.runner()
+            while True:
+                item = self._get(decoded)
+                if item is _END:
+                    break
+                index, frame = item
+                if self.grayscale and frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                enh_frame = runner.run(frame)
+                converted = writer_frame(enh_frame, self.grayscale)
+                if converted is not enh_frame:
+                    enh_frame = converted
+                elif enh_frame is not frame:
+                    # the runner reuses its output buffers for the next frame
+                    enh_frame = enh_frame.copy()
+                if not self._put(enhanced, (index, enh_frame)):
+                    break
+        except Exception as error:
+            self._fail(error)
+
+    def _write(self, enhanced, out, written, progress_callback, frame_count):
+        try:
+            # frames finish out of order, they wait here until all frames before them are written
+            waiting = {}
+            next_index = 0
+            progress_step = max(1, frame_count // 50)
+            while True:
+                item = self._get(enhanced)
+                if item is _END:
+                    break
+                index, enh_frame = item
+                waiting[index] = enh_frame
+                while next_index in waiting:
+                    out.write(waiting.pop(next_index))
+                    self._in_flight.release()
+                    next_index += 1
+                    written[0] = next_index
+                    if progress_callback is not None and frame_count > 0 and next_index % progress_step == 0:
+                        progress_callback(min(100, int(100 * next_index / frame_count)))
+        except Exception as error:
+            self._fail(error)
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cv2
+
+from scripts.seek_index import get_seek_index, seek
+
+
+class PooledCapture:
+    """
+    an open cv2.VideoCapture (or video reader backend) which remembers which frame the next read() will
+    return, so that reading the frame after the last one doesn't need a seek.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cap = None
+        self.next_frame = 0
+        self.in_use = 0
+
+    def open(self, open_capture=cv2.VideoCapture):
+        self.cap = open_capture(self.path)
+        self.next_frame = 0
+
+    def is_opened(self):
+        return self.cap is not None and self.cap.isOpened()
+
+    def read_frame(self, index):
+        """
+        reads the frame with the given index. If index is the frame directly after the last one read,
+        the frame is read straight from the open handle without seeking.
+        :param index: frame number
+        :return: ret, frame as from cv2.VideoCapture.read()
+        """
+        if index != self.next_frame:
+            # jumps to the closest keyframe once the background pass has indexed the video
+            seek(self.cap, index, get_seek_index(self.path), current_frame=self.next_frame)
+        ret, frame = self.cap.read()
+        # after a failed read the decoder position is unknown, force a seek next time
+        self.next_frame = index + 1 if ret else -1
+        return ret, frame
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+
+
+class CapturePool:
+    """
+    keeps up to max_handles video captures open (one per video path) so that the decoder doesn't have to be
+    re-initialised for every preview frame. The least recently used capture is released once the pool is full.
+    Captures are checked out exclusively, so two threads never read from the same capture at once.
+    :param open_capture: function which opens a capture for a video path, cv2.VideoCapture by default
+    """
+
+    def __init__(self, max_handles=4, open_capture=None):
+        self.max_handles = max_handles
+        self.open_capture = open_capture if open_capture is not None else cv2.VideoCapture
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    @contextmanager
+    def checkout(self, path):
+        """
+        use as: with pool.checkout(path) as capture: ret, frame = capture.read_frame(index)
+        blocks while another thread has the capture for this path checked out.
+        """
+        with self._available:
+            while path in self._handles and self._handles[path].in_use:
+                self._available.wait()
+            handle = self._handles.get(path)
+            if handle is None:
+                # only the slot is reserved here, opening a large video mustn't block the other paths
+                handle = PooledCapture(path)
+                self._handles[path] = handle
+            self._handles.move_to_end(path)
+            handle.in_use += 1
+            evicted = self._evict()
+
+        for old_handle in evicted:
+            old_handle.release()
+
+        try:
+            if handle.cap is None:
+                # the handle is checked out, so no other thread opens it at the same time
+                handle.open(self.open_capture)
+            yield handle
+        finally:
+            failed = False
+            with self._available:
+                handle.in_use -= 1
+                if not handle.is_opened() and self._handles.get(path) is handle:
+                    # don't keep captures which failed to open, the next checkout tries again
+                    del self._handles[path]
+                    failed = True
+                self._available.notify_all()
+            if failed:
+                handle.release()
+
+    def _evict(self):
+        # must be called with the pool lock held, captures which are checked out are never evicted
+        evicted = []
+        for path in list(self._handles.keys()):
+            if len(self._handles) <= self.max_handles:
+                break
+            if self._handles[path].in_use == 0:
+                evicted.append(self._handles.pop(path))
+        return evicted
+
+    def release(self, path):
+        with self._available:
+            handle = self._handles.get(path)
+            if handle is None or handle.in_use:
+                return
+            del self._handles[path]
+        handle.release()
+
+    def release_all(self):
+        with self._available:
+            handles = [handle for handle in self._handles.values() if handle.in_use == 0]
+            for handle in handles:
+                del self._handles[handle.path]
+        for handle in handles:
+            handle.release()
@@ -0,0 +1,113 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import cv2
+
+# metadata of every video probed so far, by video path
+_metadata = {}
+_metadata_lock = threading.Lock()
+
+
+@dataclass
+class VideoMetadata:
+    """
+    properties of a video, read once when the video is loaded
+    """
+    path: str
+    frame_count: int = 0
+    fps: float = 0.0
+    width: int = 0
+    height: int = 0
+    fourcc: str = ""
+    readable: bool = False
+    error: str = ""
+
+    @property
+    def duration(self):
+        if self.fps <= 0:
+            return 0.0
+        return self.frame_count / self.fps
+
+    def summary(self):
+        if not self.readable:
+            return "unreadable: " + self.error
+        return "{}x{}, {} frames, {:.2f} fps".format(self.width, self.height, self.frame_count, self.fps)
+
+
+def probe_video(path):
+    """
+    opens the video and decodes its first frame, so videos which can be opened but not decoded are caught as well
+    :param path: path of the video
+    :return: VideoMetadata
+    """
+    metadata = VideoMetadata(path=path)
+    cap = None
+    try:
+        cap = cv2.VideoCapture(path)
+        if (cap.isOpened() == False):
+            metadata.error = "video can't be opened"
+            return metadata
+
+        metadata.frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        metadata.fps = cap.get(cv2.CAP_PROP_FPS)
+        metadata.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        metadata.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        metadata.fourcc = "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip("\x00")
+
+        ret, _ = cap.read()
+        if not ret:
+            metadata.error = "first frame can't be decoded"
+        elif metadata.fps <= 0:
+            metadata.error = "frame rate unknown"
+        else:
+            metadata.readable = True
+    except cv2.error as error:
+        metadata.error = str(error)
+    finally:
+        # also if the capture raised, the probes run on a thread pool and would keep the files open
+        if cap is not None:
+            cap.release()
+
+    return metadata
+
+
+def probe_videos(paths, workers=4):
+    """
+    probes all videos in parallel and keeps their metadata for get_metadata()
+    :param paths: list of video paths
+    :param workers: number of videos probed at the same time
+    :return: list of VideoMetadata in the order of paths
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(probe_video, paths))
+
+    with _metadata_lock:
+        for metadata in results:
+            _metadata[metadata.path] = metadata
+    return results
+
+
+def get_metadata(path):
+    """
+    metadata of the video, probed now if it wasn't loaded before
+    """
+    with _metadata_lock:
+        metadata = _metadata.get(path)
+    if metadata is None:
+        metadata = probe_video(path)
+        with _metadata_lock:
+            _metadata[path] = metadata
+    return metadata
+
+
+def cached_metadata(path):
+    # only returns metadata which was probed before, never opens the video
+    with _metadata_lock:
+        return _metadata.get(path)
+
+
+def forget_metadata():
+    with _metadata_lock:
+        _metadata.clear()
@@ -0,0 +1,384 @@
+"""
+Reader backends for the preview and the export. All backends have the read()/grab()/set()/get() interface of
+cv2.VideoCapture, so they work with seek() and the capture pool, plus read_batch() to read several frames into
+one array. Readers opened with gray=True return single channel frames.
+"""
+import shutil
+import subprocess
+import time
+
+import cv2
+import numpy as np
+
+from scripts.frame_store import DEFAULT_STORE_DIR, build_store, get_store
+from scripts.video_metadata import get_metadata
+
+
+class VideoReaderBackend:
+    name = None
+
+    def __init__(self, threads=0, gray=False):
+        """
+        :param threads: number of decoder threads, 0 lets the decoder decide
+        :param gray: if True frames are returned as single channel grayscale images
+        """
+        self.threads = max(0, threads)
+        self.gray = gray
+        self.path = None
+        self.frames_read = 0
+        self.read_seconds = 0.0
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def open(self, path):
+        """
+        :param path: path of the video
+        :return: self, isOpened() tells if the video could be opened
+        """
+        raise NotImplementedError
+
+    def isOpened(self):
+        raise NotImplementedError
+
+    def read(self, frame=None):
+        """
+        :param frame: optional buffer the frame is decoded into
+        :return: ret, frame as from cv2.VideoCapture.read()
+        """
+        start = time.perf_counter()
+        ret, frame = self._read(frame)
+        self.read_seconds += time.perf_counter() - start
+        if ret:
+            self.frames_read += 1
+        return ret, frame
+
+    def _read(self, frame):
+        raise NotImplementedError
+
+    def read_batch(self, count):
+        """
+        reads up to count frames
+        :return: array of shape (frames, height, width[, 3]), fewer than count frames at the end of the video
+        """
+        frames = []
+        for _ in range(count):
+            ret, frame = self.read()
+            if not ret:
+                break
+            frames.append(frame)
+        if not frames:
+            return None
+        return np.stack(frames)
+
+    def grab(self):
+        raise NotImplementedError
+
+    def set(self, prop, value):
+        raise NotImplementedError
+
+    def get(self, prop):
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    @property
+    def fps(self):
+        # frames decoded per second of time spent in the reader
+        if self.read_seconds <= 0:
+            return 0.0
+        return self.frames_read / self.read_seconds
+
+    def stats_text(self):
+        return "{}: {} frames, {:.1f} fps".format(self.name, self.frames_read, self.fps)
+
+
+class OpenCVReader(VideoReaderBackend):
+    """
+    cv2.VideoCapture, grayscale frames are converted from the decoded BGR frames
+    """
+    name = "opencv"
+
+    def open(self, path):
+        self.path = path
+        if self.threads > 0:
+            self._cap = cv2.VideoCapture(path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, self.threads])
+        else:
+            self._cap = cv2.VideoCapture(path)
+        self._bgr_frame = None
+        return self
+
+    def isOpened(self):
+        return self._cap.isOpened()
+
+    def _read(self, frame):
+        if not self.gray:
+            return self._cap.read(frame)
+        ret, self._bgr_frame = self._cap.read(self._bgr_frame)
+        if not ret:
+            return False, None
+        if frame is not None and frame.shape != self._bgr_frame.shape[:2]:
+            frame = None
+        return True, cv2.cvtColor(self._bgr_frame, cv2.COLOR_BGR2GRAY, dst=frame)
+
+    def grab(self):
+        return self._cap.grab()
+
+    def set(self, prop, value):
+        return self._cap.set(prop, value)
+
+    def get(self, prop):
+        return self._cap.get(prop)
+
+    def release(self):
+        self._cap.release()
+
+
+class FFmpegPipeReader(VideoReaderBackend):
+    """
+    an ffmpeg subprocess decodes the video on its own threads and pipes raw frames into this process. Gray
+    readers get the luma plane from ffmpeg, no colour conversion of the frames is needed here (values can differ
+    by a few levels from the grayscale conversion of the BGR frames). Seeking restarts ffmpeg at the timestamp
+    of the frame.
+    """
+    name = "ffmpeg"
+
+    def __init__(self, threads=0, gray=False):
+        super(FFmpegPipeReader, self).__init__(threads, gray)
+        self._process = None
+        self._metadata = None
+        self._grab_buffer = None
+        self.position = 0
+
+    @classmethod
+    def available(cls):
+        return shutil.which("ffmpeg") is not None
+
+    def open(self, path):
+        if not self.available():
+            raise RuntimeError("ffmpeg reader needs ffmpeg on the PATH")
+        self.path = path
+        self._metadata = get_metadata(path)
+        if self._metadata.readable:
+            self._start(0)
+        return self
+
+    @property
+    def frame_shape(self):
+        shape = (self._metadata.height, self._metadata.width)
+        return shape if self.gray else shape + (3,)
+
+    def _start(self, frame_index):
+        self._stop()
+        command = [shutil.which("ffmpeg"), "-loglevel", "error", "-nostdin", "-threads", str(self.threads)]
+        if frame_index > 0:
+            # input seeking with decoding is frame accurate, half a frame earlier so rounding can't skip it
+            command += ["-ss", "{:.6f}".format((frame_index - 0.5) / self._metadata.fps)]
+        command += ["-i", self.path, "-map", "0:v:0", "-vsync", "passthrough",
+                    "-f", "rawvideo", "-pix_fmt", "gray" if self.gray else "bgr24", "-"]
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.position = frame_index
+
+    def _stop(self):
+        if self._process is not None:
+            self._process.stdout.close()
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def isOpened(self):
+        return self._process is not None
+
+    def _read_into(self, buffer):
+        # the pipe returns at most its buffer size per read, reads until the buffer is full or the video ended
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view):
+            count = self._process.stdout.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        return filled
+
+    def _read(self, frame):
+        if self._process is None:
+            return False, None
+        if frame is None or frame.shape != self.frame_shape or not frame.flags.c_contiguous:
+            frame = np.empty(self.frame_shape, dtype=np.uint8)
+        if self._read_into(frame) < frame.nbytes:
+            return False, None
+        self.position += 1
+        return True, frame
+
+    def read_batch(self, count):
+        # one read for all frames of the batch
+        if self._process is None:
+            return None
+        start = time.perf_counter()
+        frames = np.empty((count,) + self.frame_shape, dtype=np.uint8)
+        complete = self._read_into(frames) // frames[0].nbytes
+        self.read_seconds += time.perf_counter() - start
+        self.frames_read += complete
+        self.position += complete
+        if complete == 0:
+            return None
+        return frames[:complete]
+
+    def grab(self):
+        if self._process is None:
+            return False
+        ret, self._grab_buffer = self._read(self._grab_buffer)
+        return ret
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES or not self._metadata.readable:
+            return False
+        self._start(max(0, int(value)))
+        return True
+
+    def get(self, prop):
+        if self._metadata is None:
+            return 0.0
+        values = {cv2.CAP_PROP_POS_FRAMES: self.position,
+                  cv2.CAP_PROP_FRAME_COUNT: self._metadata.frame_count,
+                  cv2.CAP_PROP_FPS: self._metadata.fps,
+                  cv2.CAP_PROP_FRAME_WIDTH: self._metadata.width,
+                  cv2.CAP_PROP_FRAME_HEIGHT: self._metadata.height}
+        return float(values.get(prop, 0.0))
+
+    def release(self):
+        self._stop()
+
+
+class FrameStoreReader(VideoReaderBackend):
+    """
+    reads the frames from the memory-mapped frame store of the video (see frame_store). Frames are read-only
+    views into the store, so nothing is decoded or copied and seeking to any frame is free. A video without a
+    store is decoded once into a new store if build is True, otherwise it is read with the source reader.
+    """
+    name = "store"
+
+    def __init__(self, threads=0, gray=False, build=True, source_reader="opencv", store_dir=DEFAULT_STORE_DIR):
+        """
+        :param threads: decoder threads of the source reader, used while the store is built
+        :param build: build the store of videos which don't have one yet
+        :param source_reader: reader backend which decodes the video into the store
+        :param store_dir: folder the stores are kept in
+        """
+        super(FrameStoreReader, self).__init__(threads, gray)
+        self.build = build
+        self.source_reader = source_reader
+        self.store_dir = store_dir
+        self._store = None
+        self._source = None
+        self.position = 0
+
+    def open(self, path):
+        self.path = path
+        self._store = get_store(path, self.gray, self.store_dir)
+        if self._store is None and self.build:
+            source = open_reader(path, self.source_reader, {"threads": self.threads}, gray=self.gray)
+            try:
+                self._store = build_store(path, source, self.gray, self.store_dir)
+            finally:
+                source.release()
+        if self._store is None:
+            self._source = open_reader(path, self.source_reader, {"threads": self.threads}, gray=self.gray)
+        # gray frames from a colour store still need to be converted
+        self._convert = self._store is not None and self.gray and not self._store.gray
+        self.position = 0
+        return self
+
+    def isOpened(self):
+        if self._source is not None:
+            return self._source.isOpened()
+        return self._store is not None
+
+    def _read(self, frame):
+        if self._source is not None:
+            return self._source.read(frame)
+        if self.position >= len(self._store):
+            return False, None
+        store_frame = self._store.frame(self.position)
+        self.position += 1
+        if not self._convert:
+            return True, store_frame
+        if frame is not None and (frame.shape != store_frame.shape[:2] or not frame.flags.writeable):
+            frame = None
+        return True, cv2.cvtColor(store_frame, cv2.COLOR_BGR2GRAY, dst=frame)
+
+    def read_batch(self, count):
+        if self._source is not None:
+            return self._source.read_batch(count)
+        start = time.perf_counter()
+        frames = self._store.frame_range(self.position, self.position + count)
+        if len(frames) == 0:
+            return None
+        if self._convert:
+            frames = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames])
+        self.position += len(frames)
+        self.frames_read += len(frames)
+        self.read_seconds += time.perf_counter() - start
+        return frames
+
+    def grab(self):
+        if self._source is not None:
+            return self._source.grab()
+        if self.position >= len(self._store):
+            return False
+        self.position += 1
+        return True
+
+    def set(self, prop, value):
+        if self._source is not None:
+            return self._source.set(prop, value)
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.position = min(max(0, int(value)), len(self._store))
+        return True
+
+    def get(self, prop):
+        if self._source is not None:
+            return self._source.get(prop)
+        if self._store is None:
+            return 0.0
+        values = {cv2.CAP_PROP_POS_FRAMES: self.position,
+                  cv2.CAP_PROP_FRAME_COUNT: len(self._store),
+                  cv2.CAP_PROP_FPS: self._store.fps,
+                  cv2.CAP_PROP_FRAME_WIDTH: self._store.frames.shape[2],
+                  cv2.CAP_PROP_FRAME_HEIGHT: self._store.frames.shape[1]}
+        return float(values.get(prop, 0.0))
+
+    def release(self):
+        if self._source is not None:
+            self._source.release()
+        # the mapping is closed once no frame view refers to it anymore
+        self._store = None
+
+    def stats_text(self):
+        if self._source is not None:
+            return "{} (no frame store): {} frames, {:.1f} fps".format(self._source.name, self._source.frames_read,
+                                                                        self._source.fps)
+        return super(FrameStoreReader, self).stats_text()
+
+
+# reader backends by name
+READERS = {reader.name: reader for reader in [OpenCVReader, FFmpegPipeReader, FrameStoreReader]}
+
+
+def create_reader(name, **options):
+    """
+    :param name: name of the backend, see READERS
+    :param options: passed to the constructor of the backend, e.g. threads or gray
+    """
+    if name not in READERS:
+        raise ValueError("unknown video reader: {}".format(name))
+    return READERS[name](**options)
+
+
+def open_reader(path, name="opencv", reader_options=None, **extra_options):
+    # opened reader for the video, extra_options override the reader options (e.g. gray for grayscale exports)
+    options = dict(reader_options or {}, **extra_options)
+    return create_reader(name, **options).open(path)
@@ -0,0 +1,171 @@
+import threading
+
+import cv2
+import numpy as np
+
+from scripts.seek_index import load_seek_index, seek
+from scripts.video_metadata import get_metadata
+from scripts.video_readers import open_reader
+
+# statistics of every video accumulated so far, by video path
+_statistics = {}
+_statistics_lock = threading.Lock()
+
+
+class VideoStatistics:
+    """
+    intensity histogram of a whole video, accumulated over its (sampled) frames. Memory is fixed to the 256 bins,
+    all other statistics are derived from them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.histogram = np.zeros(256, dtype=np.float64)
+        self.frames_sampled = 0
+        self.stride = 1
+        self.stopped_early = False
+
+    def add_frame(self, gray_frame):
+        self.histogram += cv2.calcHist([gray_frame], [0], None, [256], [0, 256]).ravel()
+        self.frames_sampled += 1
+
+    @property
+    def pixel_count(self):
+        return self.histogram.sum()
+
+    def cdf(self):
+        # normalised cumulative histogram
+        total = max(self.pixel_count, 1.0)
+        return np.cumsum(self.histogram) / total
+
+    @property
+    def mean(self):
+        return float(np.dot(np.arange(256), self.histogram) / max(self.pixel_count, 1.0))
+
+    @property
+    def variance(self):
+        values = np.arange(256)
+        return float(np.dot((values - self.mean) ** 2, self.histogram) / max(self.pixel_count, 1.0))
+
+    def percentile(self, percent):
+        """
+        intensity below which percent % of the pixels of the video are
+        """
+        return int(np.searchsorted(self.cdf(), percent / 100.0))
+
+    def equalization_table(self):
+        """
+        histogram equalization mapping of the whole video, same formula as cv2.equalizeHist uses for one frame
+        :return: tuple of 256 values, usable as ("equalize", table) point operation
+        """
+        cdf = np.cumsum(self.histogram)
+        nonzero = cdf[cdf > 0]
+        if len(nonzero) == 0 or cdf[-1] == nonzero[0]:
+            return tuple(range(256))
+        table = np.round((cdf - nonzero[0]) * 255.0 / (cdf[-1] - nonzero[0]))
+        return tuple(int(value) for value in np.clip(table, 0, 255))
+
+    def summary(self):
+        return "{} frames sampled (every {}.), mean {:.1f}, std {:.1f}, 5-95% range {}-{}{}".format(
+            self.frames_sampled, self.stride, self.mean, np.sqrt(self.variance), self.percentile(5),
+            self.percentile(95), ", stopped early" if self.stopped_early else "")
+
+
+def sample_passes(frame_count, stride, first_pass_samples):
+    """
+    frames sampled for the statistics, grouped into passes which each cover the whole video: the first pass
+    samples at least first_pass_samples frames spread evenly over the video, every following pass the frames
+    halfway between the ones sampled before, until every stride-th frame was sampled
+    :return: list of passes, each an ascending list of frame indices
+    """
+    samples = len(range(0, frame_count, stride))
+    step = 1
+    while samples // (2 * step) >= first_pass_samples:
+        step *= 2
+    passes = [[j * stride for j in range(0, samples, step)]]
+    while step > 1:
+        step //= 2
+        passes.append([j * stride for j in range(step, samples, 2 * step)])
+    return passes
+
+
+def accumulate_video_statistics(video_path, max_samples=300, min_samples=30, tolerance=0.002,
+                                progress_callback=None):
+    """
+    accumulates the histogram of the video. Long videos are sampled with a stride, so at most max_samples frames
+    are decoded. The frames are sampled coarse to fine (see sample_passes()), each pass over the whole video
+    doubles the samples. Sampling stops early once the cumulative histogram doesn't change by more than
+    tolerance from one pass to the next, so a stable estimate still has frames from all parts of the video.
+    :param video_path: path of the video
+    :param max_samples: maximum number of frames added to the histogram
+    :param min_samples: frames sampled by the first pass, before the estimate may be considered stable
+    :param tolerance: maximum change of the normalised cumulative histogram for a stable estimate
+    :param progress_callback: optional function called with the % of the planned frames sampled
+    :return: VideoStatistics or None if the video couldn't be read
+    """
+    metadata = get_metadata(video_path)
+    if not metadata.readable:
+        print("Error opening video stream or file")
+        return None
+
+    statistics = VideoStatistics(video_path)
+    # rounded up, so the samples reach the end of the video
+    statistics.stride = max(1, -(-metadata.frame_count // max_samples))
+    passes = sample_passes(metadata.frame_count, statistics.stride, min_samples)
+    planned = sum(len(sample_pass) for sample_pass in passes)
+
+    # reads from the frame store of the video if there is one, otherwise the video is decoded. The seek index
+    # makes seeking to the sampled frames frame accurate
+    cap = open_reader(video_path, "store", {"build": False}, gray=True)
+    video_seek_index = load_seek_index(video_path)
+    last_cdf = None
+    for pass_number, sample_pass in enumerate(passes):
+        current_frame = -1
+        for frame_index in sample_pass:
+            seek(cap, frame_index, video_seek_index, current_frame=current_frame)
+            ret, frame = cap.read()
+            if not ret:
+                # e.g. the frame count of the container was too high
+                current_frame = -1
+                continue
+            current_frame = frame_index + 1
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            statistics.add_frame(frame)
+
+        if progress_callback is not None and planned > 0:
+            progress_callback(int(100 * statistics.frames_sampled / planned))
+        cdf = statistics.cdf()
+        if (last_cdf is not None and pass_number < len(passes) - 1
+                and np.abs(cdf - last_cdf).max() < tolerance):
+            statistics.stopped_early = True
+            break
+        last_cdf = cdf
+
+    cap.release()
+
+    with _statistics_lock:
+        _statistics[video_path] = statistics
+    return statistics
+
+
+def get_statistics(video_path):
+    """
+    statistics of the video, accumulated now if they weren't before
+    """
+    with _statistics_lock:
+        statistics = _statistics.get(video_path)
+    if statistics is None:
+        statistics = accumulate_video_statistics(video_path)
+    return statistics
+
+
+def cached_statistics(video_path):
+    # only returns statistics which were accumulated before, never opens the video
+    with _statistics_lock:
+        return _statistics.get(video_path)
+
+
+def forget_statistics():
+    with _statistics_lock:
+        _statistics.clear()
@@ -0,0 +1,282 @@
+"""
+Writer backends for the export. All backends have the write()/release() interface of cv2.VideoWriter and count
+the frames and bytes they write and the time spent writing, so the fastest backend can be picked for scratch
+outputs and the smallest one for archiving.
+"""
+import collections
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+class VideoWriterBackend:
+    name = None
+    # extension of the output, image sequences write into a folder and have none
+    extension = ".avi"
+    # True if the frames are stored without loss, so they can be decoded and written again
+    lossless = False
+
+    def __init__(self):
+        self.output_name = None
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+
+    def open(self, output_name, fps, frame_size, is_color=True):
+        """
+        :param output_name: path of the video (or folder of an image sequence)
+        :param fps: frame rate of the video
+        :param frame_size: (width, height)
+        :param is_color: False if single channel frames are written
+        :return: self
+        """
+        raise NotImplementedError
+
+    def write(self, frame):
+        start = time.perf_counter()
+        self._write(frame)
+        self.write_seconds += time.perf_counter() - start
+        self.frames_written += 1
+
+    def _write(self, frame):
+        raise NotImplementedError
+
+    def release(self):
+        start = time.perf_counter()
+        self._release()
+        self.write_seconds += time.perf_counter() - start
+        if self.output_name is not None and os.path.isfile(self.output_name):
+            self.bytes_written = os.path.getsize(self.output_name)
+
+    def _release(self):
+        raise NotImplementedError
+
+    @property
+    def fps(self):
+        # frames encoded per second of time spent in the writer
+        if self.write_seconds <= 0:
+            return 0.0
+        return self.frames_written / self.write_seconds
+
+    def stats_text(self):
+        return "{}: {} frames, {:.1f} fps, {:.1f} MB".format(self.name, self.frames_written, self.fps,
+                                                            self.bytes_written / (1024 * 1024))
+
+
+class OpenCVWriter(VideoWriterBackend):
+    """
+    cv2.VideoWriter with a fixed codec
+    """
+    fourcc = None
+
+    def open(self, output_name, fps, frame_size, is_color=True):
+        self.output_name = output_name
+        fourcc = cv2.VideoWriter_fourcc(*self.fourcc) if self.fourcc is not None else 0
+        self._out = cv2.VideoWriter(output_name, fourcc, fps, frame_size, isColor=is_color)
+        if not self._out.isOpened():
+            raise RuntimeError("{} writer can't open {}".format(self.name, output_name))
+        return self
+
+    def _write(self, frame):
+        self._out.write(frame)
+
+    def _release(self):
+        self._out.release()
+
+
+class MJPGWriter(OpenCVWriter):
+    # intra frames only, fast to encode and to seek in
+    name = "mjpg"
+    fourcc = "MJPG"
+
+
+class XVIDWriter(OpenCVWriter):
+    name = "xvid"
+    fourcc = "XVID"
+
+
+class FFV1Writer(OpenCVWriter):
+    # lossless, for archiving
+    name = "ffv1"
+    fourcc = "FFV1"
+    extension = ".mkv"
+    lossless = True
+
+
+class RawWriter(OpenCVWriter):
+    """
+    uncompressed frames, no encoding cost but large files. Without a fourcc OpenCV writes colour frames as
+    YUV420, which halves the colour resolution, so colour frames are stored as RGBA (4 bytes per pixel) and
+    single channel frames as 8 bit gray. Both decode to exactly the frames which were written.
+    """
+    name = "raw"
+    lossless = True
+
+    def open(self, output_name, fps, frame_size, is_color=True):
+        self.fourcc = "RGBA" if is_color else None
+        return super(RawWriter, self).open(output_name, fps, frame_size, is_color)
+
+
+class FFmpegPipeWriter(VideoWriterBackend):
+    """
+    raw frames are piped into an ffmpeg subprocess, which encodes them with any codec ffmpeg has (by default
+    H.264) on its own threads.
+    """
+    name = "ffmpeg"
+    extension = ".mp4"
+
+    def __init__(self, codec="libx264", preset="veryfast", crf=18, extra_args=None):
+        super(FFmpegPipeWriter, self).__init__()
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.extra_args = list(extra_args) if extra_args is not None else []
+        self._process = None
+        self._stderr_reader = None
+        # last lines ffmpeg printed, for the error message
+        self._stderr_lines = collections.deque(maxlen=50)
+
+    def open(self, output_name, fps, frame_size, is_color=True):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg writer needs ffmpeg on the PATH")
+        self.output_name = output_name
+        command = [ffmpeg, "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24" if is_color else "gray",
+                   "-s", "{}x{}".format(*frame_size), "-r", str(fps), "-i", "-",
+                   "-c:v", self.codec, "-pix_fmt", "yuv420p" if is_color else "gray"]
+        if self.codec == "libx264":
+            command += ["-preset", self.preset, "-crf", str(self.crf)]
+        command += self.extra_args + [output_name]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stderr_reader = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_reader.start()
+        return self
+
+    def _drain_stderr(self):
+        # ffmpeg stops once the stderr pipe is full, so it's read while the frames are written
+        for line in self._process.stderr:
+            self._stderr_lines.append(line.decode(errors="replace"))
+
+    def _error(self):
+        # waits for ffmpeg to exit, the error with its output if it failed
+        if self._process.wait() == 0:
+            return None
+        self._stderr_reader.join()
+        return RuntimeError("ffmpeg writer failed: " + "".join(self._stderr_lines))
+
+    def _write(self, frame):
+        try:
+            self._process.stdin.write(frame.tobytes() if not frame.flags.c_contiguous else memoryview(frame))
+        except BrokenPipeError:
+            # ffmpeg exited, e.g. because of an unknown codec
+            raise self._error() or RuntimeError("ffmpeg writer exited early")
+
+    def _release(self):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = self._error()
+        self._stderr_reader.join()
+        if error is not None:
+            raise error
+
+
+class ImageSequenceWriter(VideoWriterBackend):
+    """
+    writes every frame as image into a folder, the images are encoded on a pool of threads.
+    """
+    name = "png"
+    extension = ""
+    image_extension = ".png"
+    lossless = True
+
+    def __init__(self, threads=4, start_number=0, params=None):
+        """
+        :param threads: number of images encoded at the same time
+        :param start_number: number of the first frame, used when segments write into the same folder
+        :param params: cv2.imwrite parameters, e.g. [cv2.IMWRITE_JPEG_QUALITY, 95]
+        """
+        super(ImageSequenceWriter, self).__init__()
+        self.threads = max(1, threads)
+        self.start_number = start_number
+        self.params = list(params) if params is not None else []
+        self._executor = None
+        self._futures = []
+        # limits the frames waiting to be encoded, each of them is a copy
+        self._slots = threading.BoundedSemaphore(2 * self.threads)
+        self._bytes_lock = threading.Lock()
+
+    def open(self, output_name, fps, frame_size, is_color=True):
+        self.output_name = output_name
+        os.makedirs(output_name, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        return self
+
+    def _write(self, frame):
+        path = os.path.join(self.output_name, "frame_{:06d}{}".format(self.start_number + self.frames_written,
+                                                                      self.image_extension))
+        self._slots.acquire()
+        # the caller reuses its frame buffer, the encoder thread needs its own copy
+        self._futures.append(self._executor.submit(self._encode, path, frame.copy()))
+        if len(self._futures) > 4 * self.threads:
+            self._collect(wait=False)
+
+    def _encode(self, path, frame):
+        try:
+            ret, data = cv2.imencode(self.image_extension, frame, self.params)
+            if not ret:
+                raise RuntimeError("couldn't encode " + path)
+            with open(path, "wb") as image_file:
+                image_file.write(data)
+            with self._bytes_lock:
+                self.bytes_written += len(data)
+        finally:
+            self._slots.release()
+
+    def _collect(self, wait):
+        # raises the error of a failed image
+        remaining = []
+        for future in self._futures:
+            if wait or future.done():
+                future.result()
+            else:
+                remaining.append(future)
+        self._futures = remaining
+
+    def _release(self):
+        self._collect(wait=True)
+        self._executor.shutdown()
+
+    def release(self):
+        # bytes are counted while encoding, the output is a folder
+        start = time.perf_counter()
+        self._release()
+        self.write_seconds += time.perf_counter() - start
+
+
+class JPEGSequenceWriter(ImageSequenceWriter):
+    name = "jpeg"
+    image_extension = ".jpg"
+    lossless = False
+
+
+# writer backends by name
+WRITERS = {writer.name: writer for writer in [MJPGWriter, XVIDWriter, FFV1Writer, RawWriter, FFmpegPipeWriter,
+                                              ImageSequenceWriter, JPEGSequenceWriter]}
+
+
+def create_writer(name, **options):
+    """
+    :param name: name of the backend, see WRITERS
+    :param options: passed to the constructor of the backend, e.g. codec for the ffmpeg writer
+    """
+    if name not in WRITERS:
+        raise ValueError("unknown video writer: {}".format(name))
+    return WRITERS[name](**options)
@@ -4,11 +4,15 @@ import traceback
 import cgitb
 import time
 import os
+import threading
 from pathlib import Path
+import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 
 from qt_gui.videoEnhancer import Ui_MainWindow  # importing main window of the GUI
-from scripts import handle_video_preview, histograms, basic_corrections, canny_edge_detection, sharpen, save_enhanced_videos
+from scripts import handle_video_preview, histograms, save_enhanced_videos, seek_index, proxy_videos, video_metadata, \
+    enhancement_pipeline, video_statistics, video_writers, video_readers, frame_store
+from scripts.frame_cache import FrameCache
 
 """
 Locations of required executables and how to use them:
@@ -84,7 +88,131 @@ class Worker(QtCore.QRunnable):
             self.signals.finished.emit()  # Done
 
 
+class LatestRequestScheduler(QtCore.QObject):
+    '''
+    Coalesces requests which render into the same preview target (e.g. while a slider is dragged).
+    At most one worker per target runs on the thread pool. A request made while the target is busy
+    replaces any request still waiting, so only the newest one is started once the running one is done.
+    Results of requests which have been superseded in the meantime are discarded before they reach the
+    result callback, which is called in the GUI thread.
+    :param threadpool: QThreadPool the workers are started on
+    '''
+    deliver = QtCore.pyqtSignal(object)
+
+    def __init__(self, threadpool):
+        super(LatestRequestScheduler, self).__init__()
+        self.threadpool = threadpool
+        self._lock = threading.Lock()
+        self._latest = {}       # target -> number of the newest request
+        self._running = set()   # targets with a worker on the thread pool
+        self._pending = {}      # target -> newest request waiting for the running worker
+        self.deliver.connect(self._deliver)
+
+    def submit(self, target, fn, on_result, **kwargs):
+        '''
+        :param target: name of the preview target, requests for different targets don't replace each other
+        :param fn: function run on the worker thread, its return value is passed to on_result
+        :param on_result: function called in the GUI thread with the result, only if the request is still the latest
+        :param kwargs: keywords passed to fn
+        '''
+        with self._lock:
+            generation = self._latest.get(target, 0) + 1
+            self._latest[target] = generation
+            request = (target, generation, fn, on_result, kwargs)
+            if target in self._running:
+                self._pending[target] = request
+                return
+            self._running.add(target)
+        self._start(request)
+
+    def is_latest(self, target, generation):
+        with self._lock:
+            return self._latest.get(target) == generation
+
+    def _start(self, request):
+        worker = Worker(self._run, request=request)
+        self.threadpool.start(worker)
+
+    def _run(self, request, progress_callback):
+        target, generation, fn, on_result, kwargs = request
+        try:
+            # skip the work if a newer request came in before this one got a thread
+            if self.is_latest(target, generation):
+                result = fn(progress_callback=progress_callback, **kwargs)
+                self.deliver.emit((target, generation, on_result, result))
+        finally:
+            with self._lock:
+                next_request = self._pending.pop(target, None)
+                if next_request is None:
+                    self._running.discard(target)
+            if next_request is not None:
+                self._start(next_request)
+
+    def _deliver(self, delivery):
+        target, generation, on_result, result = delivery
+        if self.is_latest(target, generation):
+            on_result(result)
+
+
+class NumpyDisplay(QtCore.QObject):
+    '''
+    Shows numpy images in a QLabel.
+    The QImage wraps the numpy buffer without copying it and the array is kept alive for as long as the QImage
+    exists. Single channel images are shown as grayscale and 3 channel images are read as BGR, so no channel swap
+    is needed. The image is scaled once, straight into a pixmap which is reused between updates, so every update
+    costs a single scaled copy.
+    show() can be called from any thread, the drawing always happens in the GUI thread.
+    :param label: QLabel the images are shown in
+    '''
+    image_ready = QtCore.pyqtSignal(object)
+
+    def __init__(self, label):
+        super(NumpyDisplay, self).__init__()
+        self.label = label
+        self._buffer = None
+        self._qimage = None
+        # two pixmaps in turns, so the one being drawn into isn't shared with the label
+        self._pixmaps = [QtGui.QPixmap(), QtGui.QPixmap()]
+        self._current = 0
+        self.image_ready.connect(self._draw)
+
+    def show(self, image):
+        self.image_ready.emit(image)
+
+    def _draw(self, image):
+        if image is None:
+            return
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        if image.ndim == 2:
+            image_format = QtGui.QImage.Format_Grayscale8
+        else:
+            image_format = QtGui.QImage.Format_BGR888
+        self._buffer = image
+        self._qimage = QtGui.QImage(image.data, width, height, image.strides[0], image_format)
+
+        target_size = QtCore.QSize(width, height).scaled(self.label.width(), self.label.height(),
+                                                         QtCore.Qt.KeepAspectRatio)
+        if target_size.isEmpty():
+            return
+
+        self._current = 1 - self._current
+        pixmap = self._pixmaps[self._current]
+        if pixmap.size() != target_size:
+            pixmap = QtGui.QPixmap(target_size)
+            self._pixmaps[self._current] = pixmap
+
+        painter = QtGui.QPainter(pixmap)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        painter.drawImage(QtCore.QRect(QtCore.QPoint(0, 0), target_size), self._qimage)
+        painter.end()
+        self.label.setPixmap(pixmap)
+
+
 class videoSmith_mainWindow(QtWidgets.QMainWindow):
+    # (index of video in videolist, status text) - lets worker threads update the video list
+    video_status = QtCore.pyqtSignal(int, str)
+
     def __init__(self):
         super(videoSmith_mainWindow, self).__init__()
         self.ui = Ui_MainWindow()
@@ -93,18 +221,33 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
 
         # start thread pool
         self.threadpool = QtCore.QThreadPool()
+        # numpy images are shown in the labels through these
+        self.preview_display = NumpyDisplay(self.ui.mid_label_livePreview)
+        self.hist_orig_display = NumpyDisplay(self.ui.mid_label_histOrig)
+        self.hist_equ_display = NumpyDisplay(self.ui.mid_label_equHist)
+
+        # slider driven preview renders, only the latest request per target is rendered
+        self.render_scheduler = LatestRequestScheduler(self.threadpool)
 
         ###
         # variables
         ###
         self.videolist = []
+        self.video_items = []       # text of each video in the video list, without status
+        self.probe_workers = 4      # videos probed in parallel when loading
         self.selected_video = 0
         self.number_of_videos = 0
         self.selected_preview = 0
         self.preview_frame = self.ui.mid_horizontalSlider_frame.value()
+        self.source_frame = None    # decoded frame of the video, before enhancements
+        self.source_key = None      # identifies the source frame for the stage result cache
         self.preview_image = None   # always the current preview image
-        self.old_preview = None     # used to reset preview for toggle enhancements
         self.frame_count = 100
+        self.frame_cache_budget_mb = 256     # memory used for decoded preview frames
+        handle_video_preview.frame_cache.set_budget(self.frame_cache_budget_mb)
+        # results of the enhancement stages for recent renders, so a change only recomputes the later stages
+        self.stage_cache_budget_mb = 128
+        self.stage_cache = FrameCache(budget_mb=self.stage_cache_budget_mb, name="stage cache")
 
         # these will be used to apply settings which are true to all videos
         self.equalization = False
@@ -113,7 +256,6 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         self.brightness = False
         self.contrast = False
         self.crop = False
-        self.enhancements = [self.equalization, self.thresholding, self.gamma, self.brightness, self.contrast]
 
         # set output location
         self.output_location = os.path.join(str(Path.cwd()), "output")
@@ -123,6 +265,21 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         # video list
         self.ui.left_pushButton_loadVideos.pressed.connect(self.load_videos)
         self.ui.left_pushButton_clearVideoList.pressed.connect(self.clear_video_list)
+        self.video_status.connect(self.set_video_status)
+
+        # proxy mode: the preview reads downscaled copies of the videos, export always uses the originals
+        self.use_proxies = False
+        preview_menu = self.ui.menubar.addMenu("Preview")
+        self.proxy_action = preview_menu.addAction("use low resolution proxies")
+        self.proxy_action.setCheckable(True)
+        self.proxy_action.toggled.connect(self.toggle_proxies)
+
+        # video level equalization: one mapping from the histogram of the whole video for all of its frames
+        self.video_equalization = False
+        enhancements_menu = self.ui.menubar.addMenu("Enhancements")
+        self.video_equalization_action = enhancements_menu.addAction("equalize with whole video histogram")
+        self.video_equalization_action.setCheckable(True)
+        self.video_equalization_action.toggled.connect(self.toggle_video_equalization)
 
         # live preview
         self.ui.mid_pushButton_startPreview.pressed.connect(self.start_video_preview)
@@ -137,10 +294,11 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         # histogram stuff
         self.ui.right_pushButton_calcHist.pressed.connect(self.calculate_histogram)
         self.ui.right_pushButton_equalizeHist.pressed.connect(self.equalize_histogram)
-        self.grayframe = None
-        self.grayframe_equalized = None
+        self.clahe = False
         self.histogram_calculated = False
         self.histogram_equalized = False
+        self.hist_orig_counts = None    # raw 256 bin counts of the last calculated histograms
+        self.hist_equ_counts = None
         self.ui.right_comboBox_chooseThreshold.setDisabled(True)
         self.use_threshold = False
         self.ui.right_checkBox_useThreshold.toggled.connect(self.update_use_threshold)
@@ -152,7 +310,7 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         self.ui.right_comboBox_chooseThreshold.currentIndexChanged.connect(self.calculate_histogram)
 
         # canny edge detection
-        self.edge_image = None
+        self.canny = False
         self.ui.right_checkBox_cannyEdgeDetector.toggled.connect(self.calc_edges)
 
         # sharpen
@@ -161,25 +319,67 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
 
         # basic corrections
         self.gamma_value = 10           # [-10;10]
-        self.gamma_image = None
         self.brightness_value = 0       # [-255;255]
         self.brightness_image = None
         self.contrast_value = 0         # [-127;127]
         self.contrast_image = None
 
+        # idle time after the last slider move before the preview is rendered at full resolution
+        self.refine_timer = QtCore.QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(250)
+        self.refine_timer.timeout.connect(self.render_preview)
         self.ui.right_horizontalSlider_gamma.valueChanged.connect(self.adjust_gamma)
         self.ui.right_pushButton_applyGamma.pressed.connect(self.apply_gamma)
+        self.ui.right_horizontalSlider_brightness.valueChanged.connect(self.adjust_brightness)
+        self.ui.right_pushButton_applyBright.pressed.connect(self.apply_brightness)
+        self.ui.right_horizontalSlider_contrast.valueChanged.connect(self.adjust_contrast)
+        self.ui.right_pushButton_applyContr.pressed.connect(self.apply_contrast)
         self.crop_off_start = 0
         self.crop_off_end = 0
-        self.ui.mid_radioButton_cropVideo.pressed.connect(self.crop_video)
+        self.ui.mid_radioButton_cropVideo.toggled.connect(self.crop_video)
 
         """
         saving videos
         """
         self.progress = 0
         self.updateProgress(self.progress)
-        self.enhancements_apply = []
         self.ui.right_pushButton_ApplySettingsToAll.pressed.connect(self.apply_to_all)
+        # videos exported at the same time, each in its own process
+        self.export_workers = os.cpu_count() or 1
+        export_menu = self.ui.menubar.addMenu("Export")
+        self.export_workers_action = export_menu.addAction("number of export workers...")
+        self.export_workers_action.triggered.connect(self.set_export_workers)
+        # grayscale export: like the preview, every stage works on one channel and grayscale videos are written
+        self.grayscale_export = False
+        self.grayscale_export_action = export_menu.addAction("grayscale output")
+        self.grayscale_export_action.setCheckable(True)
+        self.grayscale_export_action.toggled.connect(self.toggle_grayscale_export)
+        # writer backend: codec and container of the output, or an image sequence
+        self.writer_name = "xvid"
+        writer_menu = export_menu.addMenu("video writer")
+        self.writer_actions = QtWidgets.QActionGroup(self)
+        for writer_name in video_writers.WRITERS:
+            action = writer_menu.addAction(writer_name)
+            action.setCheckable(True)
+            action.setChecked(writer_name == self.writer_name)
+            self.writer_actions.addAction(action)
+        self.writer_actions.triggered.connect(self.set_writer)
+        # reader backend: decodes the videos for the preview and the export
+        self.reader_name = "opencv"
+        self.reader_threads = 0
+        reader_menu = export_menu.addMenu("video reader")
+        self.reader_actions = QtWidgets.QActionGroup(self)
+        for reader_name in video_readers.READERS:
+            action = reader_menu.addAction(reader_name)
+            action.setCheckable(True)
+            action.setChecked(reader_name == self.reader_name)
+            # e.g. the ffmpeg reader needs ffmpeg on the PATH
+            action.setEnabled(video_readers.READERS[reader_name].available())
+            self.reader_actions.addAction(action)
+        self.reader_actions.triggered.connect(self.set_reader)
+        self.reader_threads_action = export_menu.addAction("number of decoder threads...")
+        self.reader_threads_action.triggered.connect(self.set_reader_threads)
 
 
     """
@@ -210,6 +410,12 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         self.ui.left_listWidget_videoList.addItem(video_filename)
         self.ui.left_listWidget_videoList.sortItems(QtCore.Qt.DescendingOrder)
 
+    def set_video_status(self, index, status):
+        if index >= len(self.video_items):
+            return
+        for item in self.ui.left_listWidget_videoList.findItems(self.video_items[index], QtCore.Qt.MatchStartsWith):
+            item.setText(self.video_items[index] + "  [" + status + "]")
+
     def load_videos(self):
         worker = Worker(self.load_videos_threaded)
         self.threadpool.start(worker)
@@ -230,6 +436,8 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
             self.log_info(str(len(selected_files)) + " videos selected!")
             self.number_of_videos = len(selected_files)
             self.videolist = selected_files
+            # statuses are shown for the videos of the new selection
+            self.video_items = []
 
             # write list of videos to listWidget
             for i, video in enumerate(self.videolist):
@@ -245,75 +453,270 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
                     item = "(" + str(i) + ")" + "  " + video
                     self.add_videos_to_list(item)
                     self.ui.left_comboBox_selectPreview.addItem(item)
+                self.video_items.append(item)
 
             self.ui.left_listWidget_videoList.sortItems(QtCore.Qt.AscendingOrder)
             self.ui.lcdNumber.display(self.number_of_videos)
 
-    def start_video_preview(self):
-        worker = Worker(self.start_video_preview_threaded)
+            # probe all videos once, preview and export reuse the metadata
+            metadata_list = video_metadata.probe_videos(self.videolist, workers=self.probe_workers)
+            unreadable = 0
+            for i, metadata in enumerate(metadata_list):
+                if not metadata.readable:
+                    unreadable += 1
+                    self.video_status.emit(i, metadata.summary())
+            if unreadable > 0:
+                self.log_info(str(unreadable) + " videos are unreadable and will be skipped on export")
+
+            # index keyframes in the background for fast seeking in preview and crop
+            self.build_seek_indices()
+            if self.use_proxies:
+                self.build_proxies()
+            if self.video_equalization:
+                self.accumulate_statistics()
+            if self.reader_name == "store":
+                self.build_frame_stores()
+
+    def build_seek_indices(self):
+        worker = Worker(self.build_seek_indices_threaded, videolist=list(self.videolist))
         self.threadpool.start(worker)
 
-    def start_video_preview_threaded(self, progress_callback):
+    def build_seek_indices_threaded(self, videolist, progress_callback):
+        for video in videolist:
+            video_seek_index = seek_index.load_or_build_seek_index(video)
+            if video_seek_index is None:
+                self.log_info("no seek index for " + str(video) + ", seeking without it")
+            else:
+                self.log_info("seek index with " + str(len(video_seek_index.keyframes)) + " keyframes ready for " + str(video))
+
+    def toggle_proxies(self, checked):
+        self.use_proxies = checked
+        handle_video_preview.set_use_proxies(checked)
+        if checked:
+            self.log_info("preview uses low resolution proxies, export uses the original videos")
+            self.build_proxies()
+        else:
+            self.log_info("preview uses the original videos")
+
+    def toggle_video_equalization(self, checked):
+        self.video_equalization = checked
+        if checked:
+            self.log_info("equalization uses the histogram of the whole video")
+            self.accumulate_statistics()
+        else:
+            self.log_info("equalization uses the histogram of each frame")
+        self.render_preview()
+
+    def accumulate_statistics(self):
+        worker = Worker(self.accumulate_statistics_threaded, videolist=list(self.videolist))
+        worker.signals.finished.connect(self.render_preview)
+        self.threadpool.start(worker)
+
+    def accumulate_statistics_threaded(self, videolist, progress_callback):
+        for i, video in enumerate(videolist):
+            if video_statistics.cached_statistics(video) is not None:
+                continue
+            self.video_status.emit(i, "histogram 0%")
+            statistics = video_statistics.accumulate_video_statistics(
+                video, progress_callback=lambda percent, i=i: self.video_status.emit(i, "histogram " + str(percent) + "%"))
+            if statistics is None:
+                self.video_status.emit(i, "histogram failed")
+            else:
+                self.video_status.emit(i, "histogram ready")
+                self.log_info(str(video) + ": " + statistics.summary())
+
+    def build_proxies(self):
+        worker = Worker(self.build_proxies_threaded, videolist=list(self.videolist))
+        self.threadpool.start(worker)
+
+    def build_proxies_threaded(self, videolist, progress_callback):
+        # one video after the other, building them in parallel would only compete for the disk
+        for i, video in enumerate(videolist):
+            self.video_status.emit(i, "proxy 0%")
+            path = proxy_videos.build_proxy(video, progress_callback=lambda percent, i=i: self.video_status.emit(
+                i, "proxy " + str(percent) + "%"))
+            if path is None:
+                self.video_status.emit(i, "proxy failed")
+            else:
+                handle_video_preview.proxies[video] = path
+                self.video_status.emit(i, "proxy ready")
+
+    def build_frame_stores(self):
+        worker = Worker(self.build_frame_stores_threaded, videolist=list(self.videolist),
+                        gray=self.grayscale_export)
+        self.threadpool.start(worker)
+
+    def build_frame_stores_threaded(self, videolist, gray, progress_callback):
+        # one video after the other like the proxies, the stores are written at disk speed
+        for i, video in enumerate(videolist):
+            if frame_store.get_store(video, gray) is not None:
+                self.video_status.emit(i, "frame store ready")
+                continue
+            self.video_status.emit(i, "frame store 0%")
+            source = video_readers.open_reader(video, "opencv", {"threads": self.reader_threads}, gray=gray)
+            try:
+                store = frame_store.build_store(video, source, gray, progress_callback=lambda percent, i=i: (
+                    self.video_status.emit(i, "frame store " + str(percent) + "%")))
+            finally:
+                source.release()
+            if store is None:
+                self.video_status.emit(i, "frame store failed")
+            else:
+                # captures opened before the store was ready decode the video, the next preview reads the store
+                handle_video_preview.release_captures(video)
+                self.video_status.emit(i, "frame store ready")
+                self.log_info("frame store of {} ready ({:.1f} GB)".format(video, store.nbytes / 1024 ** 3))
+
+    def start_video_preview(self):
         # reset everything
-        self.grayframe = None
-        self.grayframe_equalized = None
-        self.preview_image = None
-        self.histogram_calculated = False
-        self.histogram_equalized = False
-        self.gamma_image = None
-        self.gamma_value = 10
-        self.ui.right_horizontalSlider_gamma.setValue(10)
-        self.gamma = False
+        self.reset_enhancements()
         self.preview_frame = self.ui.mid_horizontalSlider_frame.value()
 
         if self.number_of_videos > 0:
             # set initial video preview:
             self.log_info("starting preview with frame: " + str(self.preview_frame))
+            self.render_scheduler.submit("preview_frame", self.start_video_preview_threaded,
+                                         self.show_video_preview_index, value=self.preview_frame,
+                                         index=self.selected_video)
 
-            preview_image, frame_count = handle_video_preview.set_default_preview(self.videolist, self.preview_frame, self.selected_video)
-            self.preview_image = preview_image
+            # enable change of videos through combo box
+            self.ui.left_comboBox_selectPreview.currentIndexChanged.connect(self.update_video_preview_index)
+        else:
+            self.log_info("Select videos first to start the live preview")
 
-            # print(preview_image)
+    def start_video_preview_threaded(self, value, index, progress_callback):
+        preview_image, frame_count = handle_video_preview.set_default_preview(self.videolist, value, index)
 
-            # update frame count and adjust length of slider:
-            self.frame_count = frame_count
-            self.ui.mid_horizontalSlider_frame.setMaximum(self.frame_count)
-            self.log_info("video " + str(self.selected_video) + " with " + str(self.frame_count) + " frames selected for preview, slider size adjusted")
+        return value, index, preview_image, frame_count
 
-            preview_image = QtGui.QImage(preview_image.data, preview_image.shape[1], preview_image.shape[0],
-                                      QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            preview_image_scaled = preview_image.scaled(self.ui.mid_label_livePreview.width(),
-                                                     self.ui.mid_label_livePreview.height(),
-                                                     QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_image_scaled))
+    def reset_enhancements(self):
+        # back to the original frame, must be called in the GUI thread
+        self.preview_image = None
+        self.histogram_calculated = False
+        self.histogram_equalized = False
+        self.equalization = False
+        self.clahe = False
+        self.gamma_value = 10
+        self.gamma = False
+        self.brightness_value = 0
+        self.brightness = False
+        self.contrast_value = 0
+        self.contrast = False
+        self.sharpen = False
+        self.canny = False
+        for widget, value in [(self.ui.right_horizontalSlider_gamma, 10),
+                              (self.ui.right_horizontalSlider_brightness, 0),
+                              (self.ui.right_horizontalSlider_contrast, 0),
+                              (self.ui.right_checkBox_sharpen, False),
+                              (self.ui.right_checkBox_cannyEdgeDetector, False)]:
+            widget.blockSignals(True)
+            if isinstance(widget, QtWidgets.QSlider):
+                widget.setValue(value)
+            else:
+                widget.setChecked(value)
+            widget.blockSignals(False)
 
-            # enable change of videos through combo box
-            self.ui.left_comboBox_selectPreview.currentIndexChanged.connect(self.update_video_preview_index)
+    def build_pipeline(self, for_preview=False):
+        """
+        the enhancements currently selected in the GUI, in the order they are applied.
+        :param for_preview: if True the basic corrections of the sliders are used even if they weren't applied yet
+        :return: EnhancementPipeline
+        """
+        pipeline = enhancement_pipeline.EnhancementPipeline()
+        if self.equalization:
+            if self.video_equalization:
+                pipeline.add(enhancement_pipeline.VideoEqualizeStage())
+            else:
+                pipeline.add(enhancement_pipeline.EqualizeStage())
+            if self.clahe:
+                pipeline.add(enhancement_pipeline.ClaheStage(clip_limit=40))
+        if (self.gamma or for_preview) and self.gamma_value != 10:
+            pipeline.add(enhancement_pipeline.GammaStage(self.gamma_value))
+        # gamma, brightness and contrast are point operations, they are compiled into one lookup table
+        if (self.brightness or for_preview) and self.brightness_value != 0:
+            pipeline.add(enhancement_pipeline.BrightnessStage(self.brightness_value))
+        if (self.contrast or for_preview) and self.contrast_value != 0:
+            pipeline.add(enhancement_pipeline.ContrastStage(self.contrast_value))
+        if self.sharpen:
+            pipeline.add(enhancement_pipeline.SharpenStage())
+        if self.canny:
+            pipeline.add(enhancement_pipeline.CannyStage())
+        return pipeline
+
+    def render_preview(self, interactive=False):
+        """
+        renders the source frame through the preview pipeline. Interactive renders (while a slider moves) are done
+        at the size of the preview window, the full resolution render follows once the input was idle for a moment.
+        """
+        if self.source_frame is None:
+            return
+
+        pipeline = self.build_pipeline(for_preview=True)
+        if pipeline.is_empty():
+            self.refine_timer.stop()
+            self.preview_image = self.source_frame
+            self.preview_display.show(self.source_frame)
+            return
+
+        display_size = None
+        if interactive:
+            display_size = (self.ui.mid_label_livePreview.width(), self.ui.mid_label_livePreview.height())
+            self.refine_timer.start()
         else:
-            self.log_info("Select videos first to start the live preview")
+            self.refine_timer.stop()
+
+        self.render_scheduler.submit("render", self.render_preview_threaded, self.show_rendered_preview,
+                                     source_frame=self.source_frame, source_key=self.source_key, pipeline=pipeline,
+                                     video_path=self.videolist[self.selected_video-1], display_size=display_size)
+
+    def render_preview_threaded(self, source_frame, source_key, pipeline, video_path, display_size,
+                                progress_callback):
+        # resolve the stages which depend on the whole video, e.g. video level equalization. Only statistics
+        # which were accumulated before are used, the preview is rendered again once they are ready
+        pipeline = pipeline.for_video(video_path, cached_only=True)
+        scale = 1.0
+        if display_size is not None:
+            source_frame, scale = handle_video_preview.downscale_for_display(source_frame, *display_size)
+
+        rendered = pipeline.run(source_frame, scale=scale, cache=self.stage_cache, source_key=source_key)
+        return rendered, scale
+
+    def show_rendered_preview(self, result):
+        rendered, scale = result
+        if scale == 1.0:
+            # only full resolution renders are used for the histograms
+            self.preview_image = rendered
+        self.preview_display.show(rendered)
 
     # update video preview when different frame selected
     def update_video_preview(self, value):
         self.selected_video = self.ui.left_comboBox_selectPreview.currentIndex()
-        worker = Worker(self.update_video_preview_threaded, value=value)
-        self.threadpool.start(worker)
+        self.render_scheduler.submit("preview_frame", self.update_video_preview_threaded, self.show_video_preview,
+                                     value=value, index=self.selected_video)
 
-    def update_video_preview_threaded(self, value, progress_callback):
-        self.preview_frame = value
-        print("value threaded: ", self.preview_frame)
-        preview_image, frame_count = handle_video_preview.update_preview(self.videolist, self.preview_frame, self.selected_video)
-        self.preview_image = preview_image
+    def update_video_preview_threaded(self, value, index, progress_callback):
+        print("value threaded: ", value)
+        preview_image, frame_count = self.read_preview_frame(value, index)
+
+        return value, preview_image
+
+    def show_video_preview(self, result):
+        self.preview_frame, self.source_frame = result
+        self.source_key = handle_video_preview.preview_key(self.videolist, self.preview_frame, self.selected_video)
+
+        self.log_info("frame " + str(self.preview_frame) + " selected for preview (" +
+                      handle_video_preview.frame_cache.stats_text() + ")")
+
+        self.render_preview(interactive=True)
 
-        self.log_info("frame " + str(self.preview_frame) + " selected for preview")
+    def read_preview_frame(self, preview_frame, selected_video):
+        # check the decoded frame cache before touching the decoder
+        preview = handle_video_preview.get_cached_preview(self.videolist, preview_frame, selected_video)
+        if preview is None:
+            preview = handle_video_preview.update_preview(self.videolist, preview_frame, selected_video)
 
-        preview_image = QtGui.QImage(preview_image.data, preview_image.shape[1], preview_image.shape[0],
-                                     QtGui.QImage.Format_Grayscale8).rgbSwapped()
-        # scale image to preview window:
-        preview_image_scaled = preview_image.scaled(self.ui.mid_label_livePreview.width(),
-                                                    self.ui.mid_label_livePreview.height(),
-                                                    QtCore.Qt.KeepAspectRatio)
-        self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_image_scaled))
+        handle_video_preview.prefetch_around(self.videolist, preview_frame, selected_video)
+        return preview
 
     # update video preview when different video selected
     def update_video_preview_index(self, value):
@@ -321,67 +724,52 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         # reset histogram because chosen video was changed
         self.histogram_calculated = False
 
-        worker = Worker(self.update_video_preview_index_threaded, value=value, index=index)
-        self.threadpool.start(worker)
+        # shares the target with frame changes, the newest of both wins
+        self.render_scheduler.submit("preview_frame", self.update_video_preview_index_threaded,
+                                     self.show_video_preview_index, value=value, index=index)
 
     def update_video_preview_index_threaded(self, value, index, progress_callback):
-        self.grayframe = None
-        self.grayframe_equalized = None
-        self.gamma_image = None
-        self.preview_image = None
+        preview_image, frame_count = self.read_preview_frame(value, index)
+
+        return value, index, preview_image, frame_count
+
+    def show_video_preview_index(self, result):
+        value, index, preview_image, frame_count = result
         self.preview_frame = value
         self.selected_video = index
-        preview_image, frame_count = handle_video_preview.update_preview(self.videolist, self.preview_frame, self.selected_video)
 
-        self.preview_image = preview_image
+        self.source_frame = preview_image
+        self.source_key = handle_video_preview.preview_key(self.videolist, value, index)
 
         self.frame_count = frame_count
         self.ui.mid_horizontalSlider_frame.setMaximum(self.frame_count)
 
         self.log_info("video " + str(self.selected_video) + " with " + str(self.frame_count) + " frames selected for preview, slider size adjusted")
-
-        preview_image = QtGui.QImage(preview_image.data, preview_image.shape[1], preview_image.shape[0],
-                                     QtGui.QImage.Format_Grayscale8).rgbSwapped()
-        # scale image to preview window:
-        preview_image_scaled = preview_image.scaled(self.ui.mid_label_livePreview.width(),
-                                                    self.ui.mid_label_livePreview.height(),
-                                                    QtCore.Qt.KeepAspectRatio)
-        self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_image_scaled))
+        self.log_info(handle_video_preview.frame_cache.stats_text())
 
         # reset histogram stuff
         self.ui.mid_label_histOrig.setText("original histogram")
         self.ui.mid_label_equHist.setText("equalized histogram")
         self.histogram_calculated = False
         self.histogram_equalized = False
-        self.grayframe = None
-        self.grayframe_equalized = None
+        self.equalization = False
+        self.clahe = False
         self.ui.mid_pushButton_updatePreview.setDisabled(True)
 
-    def update_video_preview_hist(self):
-        worker = Worker(self.update_video_preview_hist_threaded)
-        self.threadpool.start(worker)
+        self.render_preview()
 
-    def update_video_preview_hist_threaded(self, progress_callback):
-        if self.grayframe is None and self.grayframe_equalized is None:
-            image = self.preview_frame
-
-        else:
-            image = self.grayframe_equalized
-
-        image = QtGui.QImage(image.data, image.shape[1], image.shape[0], QtGui.QImage.Format_Grayscale8)
-        # scale image to preview window:
-        image_scaled = image.scaled(self.ui.mid_label_livePreview.width(),
-                                                      self.ui.mid_label_livePreview.height(),
-                                                      QtCore.Qt.KeepAspectRatio)
-
-        # add equalized frame to preview window:
-        self.ui.mid_label_livePreview.clear()
-        self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(image_scaled))
+    def update_video_preview_hist(self):
+        self.render_preview()
 
     def clear_video_list(self):
         self.ui.left_listWidget_videoList.clear()
         self.number_of_videos = 0
         self.videolist = []
+        self.video_items = []
+        handle_video_preview.release_previews()
+        seek_index.forget_seek_indices()
+        video_metadata.forget_metadata()
+        video_statistics.forget_statistics()
         self.ui.lcdNumber.display(self.number_of_videos)
         self.ui.mid_label_livePreview.setText("video preview disabled")
         self.ui.right_progressBar.setValue(0)
@@ -390,24 +778,16 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         # reset histogram stuff
         self.ui.mid_label_histOrig.setText("original histogram")
         self.ui.mid_label_equHist.setText("equalized histogram")
-        self.histogram_calculated = False
-        self.histogram_equalized = False
-        self.grayframe = None
-        self.grayframe_equalized = None
         self.ui.mid_pushButton_updatePreview.setDisabled(True)
 
         # reset enhancements
-        self.preview_image = None
+        self.source_frame = None
+        self.source_key = None
+        self.stage_cache.clear()
         self.preview_frame = 0
-        self.enhancements = []
-        self.gamma_image = None
-        self.gamma = False
-        self.gamma_value = 10
-        self.ui.right_horizontalSlider_gamma.setValue(10)
-        self.contrast = False
-        self.ui.right_horizontalSlider_contrast.setValue(0)
+        self.reset_enhancements()
+        self.brightness_image = None
         self.contrast_image = None
-        self.contrast_value = 0
 
 
     """
@@ -419,18 +799,13 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         self.threadpool.start(worker)
 
     def calculate_histogram_threaded(self, progress_callback):
-        histogram_calculated, plot_hist_orig = histograms.calculate_histogram(self.preview_image)
+        histogram_calculated, plot_hist_orig, hist_counts = histograms.calculate_histogram(self.preview_image)
         self.histogram_calculated = histogram_calculated
+        self.hist_orig_counts = hist_counts
         self.log_info("histogram calculated for " + self.ui.left_comboBox_selectPreview.currentText())
 
         # add histogram plot to label:
-        plot_hist_orig = QtGui.QImage(plot_hist_orig.data, plot_hist_orig.shape[1], plot_hist_orig.shape[0],
-                                     QtGui.QImage.Format_RGB888).rgbSwapped()
-        # scale image to preview window:
-        plot_hist_orig_scaled = plot_hist_orig.scaled(self.ui.mid_label_histOrig.width(),
-                                                    self.ui.mid_label_histOrig.height(),
-                                                    QtCore.Qt.KeepAspectRatio)
-        self.ui.mid_label_histOrig.setPixmap(QtGui.QPixmap.fromImage(plot_hist_orig_scaled))
+        self.hist_orig_display.show(plot_hist_orig)
 
     def equalize_histogram(self):
         worker = Worker(self.equalize_histogram_threaded)
@@ -440,21 +815,16 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         use_threshold = self.use_threshold
         self.threshold_text = self.ui.right_comboBox_chooseThreshold.currentText()
 
-        info, grayframe_equalized, histogram_calculated, plot_hist_equ = histograms.equalize_histogram(
-            self.histogram_calculated, self.preview_image, use_threshold, self.threshold_text)
+        # equalization is the first stage of the pipeline, so it works on the original frame
+        info, grayframe_equalized, histogram_calculated, plot_hist_equ, hist_counts = histograms.equalize_histogram(
+            self.histogram_calculated, self.source_frame, use_threshold, self.threshold_text)
         self.log_info(info)
+        self.hist_equ_counts = hist_counts
         self.histogram_calculated = histogram_calculated
-        self.grayframe_equalized = grayframe_equalized
-        self.preview_image = grayframe_equalized
-
-        plot_hist_equ = QtGui.QImage(plot_hist_equ.data, plot_hist_equ.shape[1], plot_hist_equ.shape[0],
-                                     QtGui.QImage.Format_RGB888).rgbSwapped()
-        # scale image to preview window:
-        plot_hist_equ_scaled = plot_hist_equ.scaled(self.ui.mid_label_equHist.width(),
-                                                    self.ui.mid_label_equHist.height(),
-                                                    QtCore.Qt.KeepAspectRatio)
-        # add histogram plot to label:
-        self.ui.mid_label_equHist.setPixmap(QtGui.QPixmap.fromImage(plot_hist_equ_scaled))
+        self.equalization = grayframe_equalized is not None
+        self.clahe = self.equalization and use_threshold and self.threshold_text == "CLAHE"
+
+        self.hist_equ_display.show(plot_hist_equ)
 
         self.histogram_equalized = True
         self.ui.mid_pushButton_updatePreview.setEnabled(True)
@@ -473,8 +843,8 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         else:
             self.use_threshold = False
             self.ui.right_comboBox_chooseThreshold.setDisabled(True)
-            self.grayframe = None
-            self.grayframe_equalized = None
+            self.equalization = False
+            self.clahe = False
             self.histogram_calculated = False
             self.histogram_equalized = False
             self.ui.right_comboBox_chooseThreshold.setCurrentIndex(0)
@@ -483,120 +853,63 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
 
     # gamma
     def adjust_gamma(self, value):
-        worker = Worker(self.adjust_gamma_threaded, value=value)
-        self.threadpool.start(worker)
-
-    def adjust_gamma_threaded(self, value, progress_callback):
         self.gamma_value = value
-        if self.preview_image is None:
+        if self.source_frame is None:
             self.log_info("start image preview first!")
-        else:
-            preview_image = basic_corrections.change_gamma(self.preview_image, self.gamma_value)
-            self.gamma_image = preview_image
+            return
+        # while the slider moves render at display size, the full resolution render follows once it stops
+        self.render_preview(interactive=True)
+
+    # brightness and contrast
+    def adjust_brightness(self, value):
+        self.brightness_value = value
+        if self.source_frame is None:
+            self.log_info("start image preview first!")
+            return
+        self.render_preview(interactive=True)
+
+    def apply_brightness(self):
+        self.brightness_value = self.ui.right_horizontalSlider_brightness.value()
+        self.log_info("brightness of " + str(self.brightness_value) + " applied")
+        self.brightness = True
+        self.render_preview()
+
+    def adjust_contrast(self, value):
+        self.contrast_value = value
+        if self.source_frame is None:
+            self.log_info("start image preview first!")
+            return
+        self.render_preview(interactive=True)
 
-            preview_image = QtGui.QImage(preview_image.data, preview_image.shape[1], preview_image.shape[0],
-                                         QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            preview_image_scaled = preview_image.scaled(self.ui.mid_label_livePreview.width(),
-                                                        self.ui.mid_label_livePreview.height(),
-                                                        QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_image_scaled))
+    def apply_contrast(self):
+        self.contrast_value = self.ui.right_horizontalSlider_contrast.value()
+        self.log_info("contrast of " + str(self.contrast_value) + " applied")
+        self.contrast = True
+        self.render_preview()
 
     def calc_edges(self):
-        worker = Worker(self.calc_edges_threaded)
-        self.threadpool.start(worker)
-
-    def calc_edges_threaded(self, progress_callback):
-        if self.ui.right_checkBox_cannyEdgeDetector.isChecked():
-            # check which image to use for edge detection:
-            if self.preview_image is not None:
-                if self.grayframe is not None:
-                    if self.grayframe_equalized is not None:
-                        self.edge_image = canny_edge_detection.canny_edge_detector(self.grayframe_equalized)
-                    else:
-                        self.edge_image = canny_edge_detection.canny_edge_detector(self.grayframe)
-                else:
-                    self.edge_image = canny_edge_detection.canny_edge_detector(self.preview_image)
-            else:
-                self.log_info("start video preview first!")
-
-            # display edge_image:
-            edge_image = self.edge_image
-            # add histogram plot to label:
-            edge_image = QtGui.QImage(edge_image.data, edge_image.shape[1], edge_image.shape[0],
-                                                  QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            edge_image_scaled = edge_image.scaled(self.ui.mid_label_livePreview.width(),
-                                                                  self.ui.mid_label_livePreview.height(),
-                                                                  QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(edge_image_scaled))
-        else:
-            preview = None
-            self.edge_image = None
-            # reset preview:
-            if self.preview_image is not None:
-                if self.grayframe is not None:
-                    if self.grayframe_equalized is not None:
-                        preview = self.grayframe_equalized
-                    else:
-                        preview = self.grayframe
-                else:
-                    preview = self.preview_image
-            # display edge_image:
-            preview = QtGui.QImage(preview.data, preview.shape[1], preview.shape[0],
-                                      QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            preview_scaled = preview.scaled(self.ui.mid_label_livePreview.width(),
-                                                  self.ui.mid_label_livePreview.height(),
-                                                  QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_scaled))
+        self.canny = self.ui.right_checkBox_cannyEdgeDetector.isChecked()
+        if self.source_frame is None:
+            self.log_info("start video preview first!")
+            return
+        self.render_preview()
 
     def sharpen_image(self):
-        worker = Worker(self.sharpen_image_threaded)
-        self.threadpool.start(worker)
-
-    def sharpen_image_threaded(self, progress_callback):
-        self.old_preview = self.preview_image
-        if self.ui.right_checkBox_sharpen.isChecked():
-            self.sharpen = True
-            sharpened_img = sharpen.sharpen(self.preview_image)
-
-            # display sharpened image:
-            preview = QtGui.QImage(sharpened_img.data, sharpened_img.shape[1], sharpened_img.shape[0],
-                                   QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            preview_scaled = preview.scaled(self.ui.mid_label_livePreview.width(),
-                                            self.ui.mid_label_livePreview.height(),
-                                            QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_scaled))
-
-            self.preview_image = sharpened_img
-        else:
-            # TODO: fix preview before image
-            self.sharpen = False
-            self.preview_image = self.old_preview
-
-            # display sharpened image:
-            preview = QtGui.QImage(self.old_preview.data, self.old_preview.shape[1], self.old_preview.shape[0],
-                                   QtGui.QImage.Format_Grayscale8).rgbSwapped()
-            # scale image to preview window:
-            preview_scaled = preview.scaled(self.ui.mid_label_livePreview.width(),
-                                            self.ui.mid_label_livePreview.height(),
-                                            QtCore.Qt.KeepAspectRatio)
-            self.ui.mid_label_livePreview.setPixmap(QtGui.QPixmap.fromImage(preview_scaled))
-
-            self.old_preview = None
+        self.sharpen = self.ui.right_checkBox_sharpen.isChecked()
+        self.render_preview()
 
     def apply_gamma(self):
-        self.preview_image = self.gamma_image
-        self.log_info("gamma of " + str(self.ui.right_horizontalSlider_gamma.value()) + " applied")
+        self.gamma_value = self.ui.right_horizontalSlider_gamma.value()
+        self.log_info("gamma of " + str(self.gamma_value) + " applied")
         self.gamma = True
+        self.render_preview()
 
     def crop_video(self):
-        if self.ui.mid_radioButton_cropVideo.isChecked(True):
+        # crop_off_start/crop_off_end are the number of frames cut off at the start/end of each video
+        if self.ui.mid_radioButton_cropVideo.isChecked():
             self.crop = True
-            self.crop_off_start = int(self.ui.mid_lineEdit_startCropOff.text())
-            self.crop_off_end = int(self.ui.mid_lineEdit_endCropOff.text())
+            self.crop_off_start = int(self.ui.mid_lineEdit_startCropOff.text() or 0)
+            self.crop_off_end = int(self.ui.mid_lineEdit_endCropOff.text() or 0)
         else:
             self.crop = False
             self.crop_off_start = 0
@@ -611,28 +924,74 @@ class videoSmith_mainWindow(QtWidgets.QMainWindow):
         self.threadpool.start(worker)
 
     def apply_to_all_threaded(self, progress_callback):
-        enhancement_dict = {}
-        for enh in self.enhancements:
-            if enh == True:
-                print("enh: ", enh)
-                self.enhancements_apply.append(enh)
-                # enhancement_dict[str(enh)] = value
-
-            else:
-                continue
+        # export runs the same pipeline the preview shows, except for gamma which is only used once applied
+        pipeline = self.build_pipeline()
         self.log_info("following enhancements will be applied to videos: ")
-        for element in self.enhancements_apply:
-            self.log_info("- " + str(element))
+        for element in pipeline.describe():
+            self.log_info("- " + element)
 
-        # TODO: amend for all enhancements
-        success_msg = save_enhanced_videos.save_new_videos(self.output_location, self.videolist, self.enhancements_apply,
+        # spare export workers encode segments of long videos, free cores enhance frames within each segment
+        segments, enhance_workers = save_enhanced_videos.plan_export_workers(
+            self.export_workers, len(self.videolist), writer=self.writer_name)
+
+        success_msg = save_enhanced_videos.save_new_videos(self.output_location, self.videolist, pipeline.describe(),
                                                            self.crop, self.crop_off_start, self.crop_off_end,
-                                                           self.gamma, self.gamma_value, callback=progress_callback)
+                                                           self.gamma, self.gamma_value, callback=progress_callback,
+                                                           pipeline=pipeline, workers=self.export_workers,
+                                                           enhance_workers=enhance_workers, segments=segments,
+                                                           grayscale=self.grayscale_export,
+                                                           writer=self.writer_name, reader=self.reader_name,
+                                                           reader_options={"threads": self.reader_threads})
         progress_callback.emit(100)
 
-        self.log_info(success_msg)
+        # first line is the summary, then one line per video with the export path it took
+        for line in success_msg.split("\n"):
+            self.log_info(line)
 
-        self.enhancements_apply = []
+    def toggle_grayscale_export(self, checked):
+        self.grayscale_export = checked
+        if checked:
+            self.log_info("videos are processed and saved in grayscale, like the preview")
+        else:
+            self.log_info("videos are processed and saved in colour")
+
+    def set_writer(self, action):
+        self.writer_name = action.text()
+        self.log_info("videos are written with the " + self.writer_name + " writer")
+
+    def set_reader(self, action):
+        self.reader_name = action.text()
+        self.update_preview_reader()
+        if self.reader_name == "store":
+            self.log_info("videos are decoded once into frame stores in " + frame_store.DEFAULT_STORE_DIR +
+                          ", preview and export read the frames from there")
+            self.build_frame_stores()
+        else:
+            self.log_info("videos are decoded with the " + self.reader_name + " reader")
+
+    def set_reader_threads(self):
+        threads, ok = QtWidgets.QInputDialog.getInt(self, "Export", "decoder threads per video (0 = automatic):",
+                                                    self.reader_threads, 0, 64)
+        if ok:
+            self.reader_threads = threads
+            self.update_preview_reader()
+            self.log_info("decoder threads per video: " + (str(threads) if threads > 0 else "automatic"))
+
+    def update_preview_reader(self):
+        # frames decoded by the old reader are dropped, gray frames of the readers can differ slightly
+        options = {"threads": self.reader_threads}
+        if self.reader_name == "store":
+            # stores are built in the background, the preview doesn't wait for them
+            options["build"] = False
+        handle_video_preview.set_reader(self.reader_name, options)
+        self.stage_cache.clear()
+
+    def set_export_workers(self):
+        workers, ok = QtWidgets.QInputDialog.getInt(self, "Export", "number of videos exported at the same time:",
+                                                    self.export_workers, 1, 256)
+        if ok:
+            self.export_workers = workers
+            self.log_info("exporting " + str(workers) + " videos at the same time")
 
     def updateProgress(self, progress):
         self.progress = progress
@@ -0,0 +1,253 @@
+"""
+Command line batch export without the GUI, e.g. for nightly batches on machines without a display.
+Runs the same export as "apply to all" in videoSmith.py.
+
+    python videoSmith_cli.py export "/data/session1/*.avi" --list more_videos.txt -o /data/enhanced \
+        --pipeline pipeline.json --crop-start 100 --crop-end 50
+
+The pipeline file is a JSON (or YAML, if PyYAML is installed) file like
+    {"stages": [{"stage": "gamma", "gamma_value": 15}, {"stage": "sharpen"}]}
+Progress is printed as one JSON object per line on stdout, everything else goes to stderr. The exit code is 1
+if any video couldn't be exported.
+
+Large batches can be spread over several machines with a job queue in a shared folder (see job_queue):
+
+    python videoSmith_cli.py queue submit /nfs/spool "/nfs/videos/**/*.avi" -o /nfs/enhanced --pipeline p.json
+    python videoSmith_cli.py queue work /nfs/spool --exit-when-empty     (on every machine, as often as wanted)
+    python videoSmith_cli.py queue status /nfs/spool
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+from scripts import job_queue, save_enhanced_videos, seek_index, video_metadata
+from scripts.enhancement_pipeline import EnhancementPipeline
+from scripts.video_readers import READERS
+from scripts.video_writers import WRITERS
+
+
+class JsonProgress:
+    """
+    stands in for the progress signal of the GUI worker, every change of the % is printed as JSON line
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.last_percent = None
+
+    def emit(self, percent):
+        if percent != self.last_percent:
+            self.last_percent = percent
+            print_event(self.output, "progress", percent=percent)
+
+
+def print_event(stream, event, **values):
+    stream.write(json.dumps(dict(event=event, **values)) + "\n")
+    stream.flush()
+
+
+def expand_inputs(patterns, list_files):
+    """
+    :param patterns: video paths or glob patterns
+    :param list_files: text files with one video path per line, lines starting with # are skipped
+    :return: list of video paths in the given order, without duplicates
+    """
+    videos = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        # paths which don't exist are kept, so they are reported as unreadable instead of silently dropped
+        videos += matches if matches else [pattern]
+    for list_file in list_files:
+        with open(list_file) as video_list:
+            for line in video_list:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    videos.append(line)
+    return list(dict.fromkeys(videos))
+
+
+def load_pipeline(path):
+    """
+    reads a pipeline saved with EnhancementPipeline.to_dict() from a JSON or YAML file. A plain list of
+    stages is accepted as well.
+    """
+    with open(path) as pipeline_file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("reading YAML pipelines needs PyYAML (pip install pyyaml), or use JSON")
+            pipeline_dict = yaml.safe_load(pipeline_file)
+        else:
+            pipeline_dict = json.load(pipeline_file)
+    if isinstance(pipeline_dict, list):
+        pipeline_dict = {"stages": pipeline_dict}
+    return EnhancementPipeline.from_dict(pipeline_dict or {})
+
+
+def add_export_arguments(parser):
+    # options of the export engine, shared by all commands which export videos
+    parser.add_argument("--pipeline", help="JSON or YAML file with the enhancement pipeline, none copies the videos")
+    parser.add_argument("--crop-start", type=int, default=0, help="frames cut off at the start of each video")
+    parser.add_argument("--crop-end", type=int, default=0, help="frames cut off at the end of each video")
+    parser.add_argument("--grayscale", action="store_true", help="process and save single channel videos")
+    parser.add_argument("--writer", default="xvid", choices=sorted(WRITERS), help="video writer backend")
+    parser.add_argument("--writer-options", type=json.loads, default=None,
+                        help='JSON options of the writer, e.g. \'{"codec": "libx265"}\'')
+    parser.add_argument("--reader", default="opencv", choices=sorted(READERS), help="video reader backend")
+    parser.add_argument("--reader-options", type=json.loads, default=None,
+                        help='JSON options of the reader, e.g. \'{"threads": 4}\'')
+
+
+def export_command(args, output):
+    videos = expand_inputs(args.inputs, args.list)
+    if not videos:
+        print("no videos given", file=sys.stderr)
+        return 2
+    pipeline = load_pipeline(args.pipeline) if args.pipeline else EnhancementPipeline()
+    crop = args.crop_start > 0 or args.crop_end > 0
+
+    metadata_list = video_metadata.probe_videos(videos, workers=args.workers)
+    print_event(output, "start", videos=len(videos), output=args.output, pipeline=pipeline.describe(),
+                unreadable=[metadata.path for metadata in metadata_list if not metadata.readable])
+    if args.crop_start > 0:
+        # frame accurate seeking to the crop start, in the GUI the indices are built when the videos are loaded
+        for metadata in metadata_list:
+            if metadata.readable:
+                seek_index.load_or_build_seek_index(metadata.path)
+
+    segments, enhance_workers = save_enhanced_videos.plan_export_workers(args.workers, len(videos),
+                                                                         writer=args.writer)
+    progress = JsonProgress(output)
+    skipped, failed, methods = save_enhanced_videos.export_videos(
+        args.output, videos, pipeline, crop, args.crop_start, args.crop_end, callback=progress,
+        workers=args.workers, enhance_workers=enhance_workers, segments=segments, grayscale=args.grayscale,
+        writer=args.writer, writer_options=args.writer_options, reader=args.reader,
+        reader_options=args.reader_options)
+    progress.emit(100)
+
+    for video in videos:
+        if video in methods:
+            print_event(output, "video", video=video, status="done", method=methods[video])
+        elif video in skipped:
+            print_event(output, "video", video=video, status="skipped")
+        else:
+            print_event(output, "video", video=video, status="failed")
+    print_event(output, "done", exported=len(methods), skipped=len(skipped), failed=len(failed))
+    return 1 if skipped or failed else 0
+
+
+def export_options(args):
+    # options of export_videos() given on the command line
+    return dict(grayscale=args.grayscale, writer=args.writer, writer_options=args.writer_options,
+                reader=args.reader, reader_options=args.reader_options)
+
+
+def queue_submit_command(args, output):
+    videos = expand_inputs(args.inputs, args.list)
+    if not videos:
+        print("no videos given", file=sys.stderr)
+        return 2
+    pipeline = load_pipeline(args.pipeline) if args.pipeline else EnhancementPipeline()
+    crop = args.crop_start > 0 or args.crop_end > 0
+    queue = job_queue.JobQueue(args.spool)
+    for video in videos:
+        # workers on other machines need the same paths
+        job_id = queue.submit(os.path.abspath(video), os.path.abspath(args.output), pipeline, crop,
+                              args.crop_start, args.crop_end, **export_options(args))
+        print_event(output, "submitted", job=job_id, video=video)
+    print_event(output, "status", **queue.status())
+    return 0
+
+
+def queue_work_command(args, output):
+    queue = job_queue.JobQueue(args.spool, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    failed = []
+
+    def job_event(event, values):
+        if event == "finished" and values["state"] == "failed":
+            failed.append(values["job"])
+        print_event(output, event, **values)
+
+    finished = job_queue.run_worker(queue, poll_seconds=args.poll, exit_when_empty=args.exit_when_empty,
+                                    max_jobs=args.max_jobs, threads=args.threads, event_callback=job_event)
+    print_event(output, "done", finished=finished, failed=len(failed))
+    return 1 if failed else 0
+
+
+def queue_status_command(args, output):
+    queue = job_queue.JobQueue(args.spool, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    if args.requeue:
+        for job_id in queue.requeue_stale():
+            print_event(output, "requeued", job=job_id)
+    if args.retry_failed:
+        for job_id in queue.retry_failed():
+            print_event(output, "retried", job=job_id)
+    print_event(output, "status", **queue.status())
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="enhance videos without the GUI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="enhance and save videos")
+    export.add_argument("inputs", nargs="*", help="video paths or glob patterns (quote them)")
+    export.add_argument("--list", action="append", default=[], help="text file with one video path per line")
+    export.add_argument("-o", "--output", required=True, help="output folder")
+    export.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of videos exported at the same time")
+    add_export_arguments(export)
+    export.set_defaults(run=export_command)
+
+    queue = commands.add_parser("queue", help="export videos with workers on several machines")
+    queue_commands = queue.add_subparsers(dest="queue_command", required=True)
+    lease = argparse.ArgumentParser(add_help=False)
+    lease.add_argument("--lease", type=float, default=300,
+                       help="seconds after which the job of a worker which stopped renewing it is requeued")
+    lease.add_argument("--max-attempts", type=int, default=3, help="attempts before a job is moved to failed")
+
+    submit = queue_commands.add_parser("submit", help="add one job per video to the queue")
+    submit.add_argument("spool", help="queue folder, shared by all workers")
+    submit.add_argument("inputs", nargs="*", help="video paths or glob patterns (quote them)")
+    submit.add_argument("--list", action="append", default=[], help="text file with one video path per line")
+    submit.add_argument("-o", "--output", required=True, help="output folder, must be writable by all workers")
+    add_export_arguments(submit)
+    submit.set_defaults(run=queue_submit_command)
+
+    work = queue_commands.add_parser("work", parents=[lease], help="claim and export jobs of the queue")
+    work.add_argument("spool", help="queue folder, shared by all workers")
+    work.add_argument("--poll", type=float, default=10, help="seconds between two looks into an empty queue")
+    work.add_argument("--exit-when-empty", action="store_true", help="stop once no job is pending")
+    work.add_argument("--max-jobs", type=int, default=None, help="stop after this many jobs")
+    work.add_argument("--threads", type=int, default=None, help="cores used per job, all cores by default")
+    work.set_defaults(run=queue_work_command)
+
+    status = queue_commands.add_parser("status", parents=[lease], help="number of jobs in every state")
+    status.add_argument("spool", help="queue folder, shared by all workers")
+    status.add_argument("--requeue", action="store_true", help="requeue jobs with expired leases")
+    status.add_argument("--retry-failed", action="store_true", help="move failed jobs back into the queue")
+    status.set_defaults(run=queue_status_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # the export prints its log on stdout (also in the worker processes), which is kept for the JSON lines
+    sys.stdout.flush()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    try:
+        return args.run(args, output)
+    except Exception as error:
+        print_event(output, "error", message=str(error))
+        return 1
+    finally:
+        output.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())